@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+"""
+A small multi-pattern search engine. All peptides get compiled into one Aho-Corasick automaton, so every protein
+sequence only has to be scanned once to find all of the peptides occurring in it.
+Uses the pyahocorasick C extension when it is installed and falls back to a pure python automaton otherwise.
+"""
+from collections import deque
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+def build_automaton(peptides):
+    """Compiles a list of peptides into an automaton, matches are reported as indices of that list"""
+    patterns = {}
+    for index, peptide in enumerate(peptides):
+        patterns.setdefault(peptide, []).append(index)
+    # An empty pattern is found in any sequence, it can't be stored in the automaton itself
+    empty = patterns.pop("", [])
+
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for peptide, indices in patterns.items():
+            automaton.add_word(peptide, (len(peptide), indices))
+        if patterns:
+            automaton.make_automaton()
+        return automaton, empty
+
+    goto = [{}]
+    output = [None]
+    for peptide, indices in patterns.items():
+        state = 0
+        for residue in peptide:
+            next_state = goto[state].get(residue)
+            if next_state is None:
+                next_state = len(goto)
+                goto[state][residue] = next_state
+                goto.append({})
+                output.append(None)
+            state = next_state
+        output[state] = (len(peptide), indices)
+
+    # Breadth first pass to set the failure links and the links to the next state that has an output
+    fail = [0] * len(goto)
+    dict_link = [0] * len(goto)
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for residue, child in goto[state].items():
+            queue.append(child)
+            fallback = fail[state]
+            while fallback and residue not in goto[fallback]:
+                fallback = fail[fallback]
+            if state:
+                fail[child] = goto[fallback].get(residue, 0)
+            dict_link[child] = fail[child] if output[fail[child]] is not None else dict_link[fail[child]]
+    return (goto, fail, dict_link, output), empty
+
+
+def iter_matches(automaton, sequence):
+    """Scans the sequence once and yields (end position, pattern length, peptide indices) for every match"""
+    automaton, empty = automaton
+    if empty:
+        yield -1, 0, empty
+
+    if ahocorasick is not None:
+        if len(automaton):
+            for end, (length, indices) in automaton.iter(sequence):
+                yield end, length, indices
+        return
+
+    goto, fail, dict_link, output = automaton
+    state = 0
+    for end, residue in enumerate(sequence):
+        while state and residue not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(residue, 0)
+        match = state if output[state] is not None else dict_link[state]
+        while match:
+            length, indices = output[match]
+            yield end, length, indices
+            match = dict_link[match]
+
+
+def search(automaton, sequence):
+    """Returns the indices of all peptides that occur in the sequence"""
+    found = set()
+    for _, _, indices in iter_matches(automaton, sequence):
+        found.update(indices)
+    return found
@@ -1,45 +1,139 @@
 #!/usr/bin/python3
 """
 A short module that converts PEAKS protein-peptide.csv files to pandas dataframes in which the peptide column has
-been tidied up for further analysis purposes.
+been tidied up for further analysis purposes. Peptide lists are returned as a PeptideTable.
 """
+import os
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
 
+import stage_scheduler
+import table_cache
+from peptide_table import PeptideTable
+
+
+# Part of the cache key, increase it whenever the cleaning of the tables changes
+CACHE_VERSION = 1
+MODIFICATION_PATTERN = r'\([^()]*\)'
+FLANK_PATTERN = r'^(?:([^.()])\.)?(.*?)(?:\.([^.()]))?$'
+
 
 def clean_peptide_col(peptide):
     """Cleans up the peptide column entry by removing unnecessary information and returns the peptide"""
-    no_parentheses_pep = re.sub(r'\([^()]*\)', '', peptide)
+    no_parentheses_pep = re.sub(MODIFICATION_PATTERN, '', peptide)
     stripped_pep = no_parentheses_pep.replace('.', '')
     return stripped_pep
 
 
-def extract_csv_data(input_file, drop_dupes):
-    """Reads PEAKS protein-peptide.csv file as dataframe with only unique peptides present"""
-    csv_data = pd.read_csv(input_file, header='infer', delimiter=',')
-    for i, row in csv_data.iterrows():
-        raw_peptide = csv_data.at[i, 'Peptide']
-        csv_data.at[i, 'Peptide'] = clean_peptide_col(raw_peptide)
+def split_flanks(raw_peptides):
+    """Splits the PEAKS peptide notation 'K.PEPTIDE.R' into the flanking residues and the modified core sequence"""
+    parts = raw_peptides.str.extract(FLANK_PATTERN, expand=True)
+    parts.columns = ['N-flank', 'Core', 'C-flank']
+    return parts
+
+
+def clean_peptides(raw_peptides, strip_flanks=False):
+    """Vectorized version of clean_peptide_col, optionally also strips the flanking residues"""
+    if strip_flanks:
+        raw_peptides = split_flanks(raw_peptides)['Core']
+    return raw_peptides.str.replace(MODIFICATION_PATTERN, '', regex=True).str.replace('.', '', regex=False)
+
+
+def extract_modifications(raw_peptides):
+    """Returns one row per PTM annotation with the index of its peptide, its position in the peptide without flanking
+    residues (0 for N-terminal modifications), the modified residue and the mass shift"""
+    matches = split_flanks(raw_peptides)['Core'].str.extractall(r'([^()]*)\(([^()]*)\)')
+    preceding = matches[0].fillna('').str.replace('.', '', regex=False)
+    positions = preceding.str.len().groupby(level=0).cumsum()
+    # A residue carrying more than one modification is only written before the first one
+    residues = preceding.str[-1:].replace('', np.nan).groupby(level=0).ffill().fillna('N-term')
+    return pd.DataFrame({
+        'Row': matches.index.get_level_values(0),
+        'Position': positions.astype(np.int16).values,
+        'Residue': residues.astype('category').values,
+        'Mass shift': pd.to_numeric(matches[1], errors='coerce').astype(np.float32).values,
+    })
+
+
+def extract_csv_data(input_file, drop_dupes, columns=('Peptide',), strip_flanks=False, modifications=False):
+    """Reads PEAKS protein-peptide.csv file as dataframe with only unique peptides present
+
+    Only the given columns are read (all of them when columns is None). With modifications the flanking residues,
+    the number of PTMs and their summed mass shift are added as columns, extract_modifications gives the PTMs
+    themselves. Cleaned tables are kept in the table_cache."""
+    options = {'version': CACHE_VERSION, 'columns': None if columns is None else list(columns),
+               'strip_flanks': strip_flanks, 'modifications': modifications, 'drop_dupes': drop_dupes}
+    csv_data = table_cache.load_table(input_file, options)
+    if csv_data is not None:
+        return csv_data
+
+    usecols = None if columns is None else list(dict.fromkeys(['Peptide'] + list(columns)))
+    csv_data = pd.read_csv(input_file, header='infer', delimiter=',', usecols=usecols, dtype={'Peptide': str})
+    raw_peptides = csv_data['Peptide']
+    csv_data['Peptide'] = clean_peptides(raw_peptides, strip_flanks)
+    if modifications:
+        flanks = split_flanks(raw_peptides)
+        csv_data['N-flank'] = flanks['N-flank'].fillna('').astype('category')
+        csv_data['C-flank'] = flanks['C-flank'].fillna('').astype('category')
+        ptms = extract_modifications(raw_peptides).groupby('Row')['Mass shift']
+        csv_data['PTMs'] = ptms.size().reindex(csv_data.index, fill_value=0).astype(np.uint8)
+        csv_data['Mass shift'] = ptms.sum().reindex(csv_data.index, fill_value=0).astype(np.float32)
     if drop_dupes:
         csv_data = csv_data.drop_duplicates(subset=['Peptide'], keep='first').reset_index(drop=True)
+    table_cache.store_table(input_file, options, csv_data)
     return csv_data
 
 
-def join_dataframes(data):
-    """Takes list of CSV files and concatenates them into 1 big dataframe"""
-    joined_dataframe = pd.DataFrame()
+def list_csv_files(data):
+    """Returns the CSV files listed in a .txt file, or the CSV file itself"""
     if data.endswith(".txt"):
         with open(data, "r") as file_list:
-            for file in file_list:
-                csv_data = extract_csv_data(file.strip(), drop_dupes=True)
-                joined_dataframe = joined_dataframe.append(csv_data[['Peptide']], ignore_index=True)\
-                    .drop_duplicates(subset=['Peptide'], keep='first').reset_index(drop=True)
+            return [file.strip() for file in file_list if file.strip()]
+    return [data.strip()]
+
+
+def load_peptide_table(input_file):
+    """Reads the unique peptides of one CSV file as a PeptideTable"""
+    return PeptideTable.from_frame(extract_csv_data(input_file, drop_dupes=True))
+
+
+def load_peptides(input_file):
+    """Reads the unique peptides of one CSV file and returns them with the time it took to load them"""
+    started = time.perf_counter()
+    peptides = load_peptide_table(input_file)
+    return peptides, time.perf_counter() - started
+
+
+def join_dataframes(data, workers=None):
+    """Takes list of CSV files and concatenates their peptides into 1 PeptideTable
+
+    The files are loaded concurrently by a pool of <workers> processes, every peptide is kept at its first
+    occurrence in file order. A single file, or a single worker, is loaded in this process."""
+    files = list_csv_files(data)
+    if not files:
+        return PeptideTable.from_peptides([])
+    workers = min(workers or os.cpu_count(), len(files))
+    if workers == 1:
+        tables = report_loaded(files, map(load_peptides, files))
     else:
-        csv_data = extract_csv_data(data.strip(), drop_dupes=True)
-        joined_dataframe = joined_dataframe.append(csv_data[['Peptide']], ignore_index=True) \
-            .drop_duplicates(subset=['Peptide'], keep='first').reset_index(drop=True)
-    return joined_dataframe
+        with ProcessPoolExecutor(max_workers=workers, mp_context=stage_scheduler.pool_context(),
+                                 initializer=table_cache.configure,
+                                 initargs=table_cache.current_settings()) as executor:
+            tables = report_loaded(files, executor.map(load_peptides, files))
+    return PeptideTable.concat(tables).unique().reset_index()
+
+
+def report_loaded(files, results):
+    """Prints the load time of every file and returns the loaded PeptideTables"""
+    tables = []
+    for file, (peptides, seconds) in zip(files, results):
+        tables.append(peptides)
+        print("Loaded {} peptides from {} in {:.2f}s".format(len(peptides), file, seconds))
+    return tables
 
 
 def trim_first_last(peptide_file):
@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+"""
+A lightweight fasta reader shared by the modules reading fasta databases. Uncompressed files are memory-mapped,
+gzip, BGZF and zstd compressed files are decompressed while streaming through them.
+Uncompressed and BGZF files can be split into byte ranges aligned to the record headers, so parallel workers each
+seek straight to their own slice of a database. For these files a samtools style .fai index gives random access to
+the sequence of a record by its name or UniProt accession; BGZF files also get a .gzi index of their blocks.
+"""
+import argparse
+import bisect
+import datetime
+import gzip
+import io
+import mmap
+import os
+import struct
+import sys
+from contextlib import contextmanager
+
+from Bio import bgzf
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+READ_SIZE = 4 * 1024 ** 2
+# Stands in for the unknown size of a compressed stream that can't be split
+UNBOUNDED = sys.maxsize
+
+
+def compression(fasta_file):
+    """Returns the compression of the file from its first bytes: None, 'gzip', 'bgzf' or 'zstd'"""
+    with open(fasta_file, "rb") as fasta:
+        start = fasta.read(16)
+    if start.startswith(GZIP_MAGIC):
+        # BGZF is gzip with a 'BC' extra subfield in the header of every block
+        if len(start) >= 14 and start[3] & 4 and start[12:14] == b"BC":
+            return "bgzf"
+        return "gzip"
+    if start.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+
+def open_fasta(fasta_file):
+    """Opens the fasta file as a binary stream of its uncompressed content"""
+    kind = compression(fasta_file)
+    if kind in ("gzip", "bgzf"):
+        return gzip.open(fasta_file, "rb")
+    if kind == "zstd":
+        if zstandard is None:
+            raise ImportError("Reading zstd compressed {} requires the zstandard library".format(fasta_file))
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(fasta_file, "rb"), closefd=True),
+                                 READ_SIZE)
+    return open(fasta_file, "rb")
+
+
+def strip_compression(fasta_file):
+    """Returns the file name without a .gz, .bgz or .zst extension"""
+    root, extension = os.path.splitext(fasta_file)
+    return root if extension in (".gz", ".bgz", ".zst") else fasta_file
+
+
+def index_is_current(index_file, fasta_file):
+    try:
+        return os.path.getmtime(index_file) >= os.path.getmtime(fasta_file)
+    except FileNotFoundError:
+        return False
+
+
+def bgzf_blocks(fasta_file):
+    """Returns the (compressed offset, uncompressed offset) of every BGZF block, read from the .gzi index next to the
+    file or built by walking the block headers. The index is written in the samtools .gzi format when possible"""
+    gzi_file = fasta_file + ".gzi"
+    if index_is_current(gzi_file, fasta_file):
+        with open(gzi_file, "rb") as gzi:
+            count, = struct.unpack("<Q", gzi.read(8))
+            values = struct.unpack("<{}Q".format(2 * count), gzi.read(16 * count))
+        return [(0, 0)] + list(zip(values[::2], values[1::2]))
+
+    blocks = []
+    uncompressed = 0
+    with open(fasta_file, "rb") as fasta:
+        for start, _, _, data_length in bgzf.BgzfBlocks(fasta):
+            blocks.append((start, uncompressed))
+            uncompressed += data_length
+    # The closing block holds the total size, which is what shard_offsets needs
+    blocks.append((os.path.getsize(fasta_file), uncompressed))
+    try:
+        with open(gzi_file, "wb") as gzi:
+            gzi.write(struct.pack("<Q", len(blocks) - 1))
+            for block in blocks[1:]:
+                gzi.write(struct.pack("<2Q", *block))
+    except OSError:
+        pass
+    return blocks
+
+
+def virtual_offset(blocks, offset):
+    """Converts an offset in the uncompressed content into a BGZF virtual offset"""
+    number = bisect.bisect_right([uncompressed for _, uncompressed in blocks], offset) - 1
+    compressed, uncompressed = blocks[number]
+    return (compressed << 16) | (offset - uncompressed)
+
+
+def uncompressed_size(fasta_file, kind):
+    if kind == "bgzf":
+        return bgzf_blocks(fasta_file)[-1][1]
+    return os.path.getsize(fasta_file)
+
+
+def open_at(fasta_file, kind, offset):
+    """Opens an uncompressed or BGZF file as a binary stream positioned at an offset of the uncompressed content"""
+    if kind == "bgzf":
+        reader = bgzf.BgzfReader(fasta_file, "rb")
+        reader.seek(virtual_offset(bgzf_blocks(fasta_file), offset))
+        return reader
+    fasta = open(fasta_file, "rb")
+    fasta.seek(offset)
+    return fasta
+
+
+def shard_offsets(fasta_file, n):
+    """Splits the fasta file into n byte ranges that each start at a record header. Gzip and zstd streams can't be
+    split, their content ends up in the first range"""
+    kind = compression(fasta_file)
+    if kind not in (None, "bgzf"):
+        return [(0, UNBOUNDED)] + [(0, 0)] * (n - 1)
+    size = uncompressed_size(fasta_file, kind)
+    if size == 0:
+        return [(0, 0)] * n
+    if kind is None:
+        with open(fasta_file, "rb") as fasta, mmap.mmap(fasta.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            bounds = [0]
+            for i in range(1, n):
+                # Searching from one byte back also catches a header that starts exactly at the split point
+                header = data.find(b"\n>", max(size * i // n - 1, bounds[-1]))
+                bounds.append(size if header == -1 else header + 1)
+            bounds.append(size)
+    else:
+        bounds = [0]
+        for i in range(1, n):
+            bounds.append(find_header(fasta_file, kind, max(size * i // n - 1, bounds[-1]), size))
+        bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(n)]
+
+
+def find_header(fasta_file, kind, offset, size):
+    """Returns the offset of the first record header after a '\\n' at or after the offset, or size when there is none"""
+    if offset >= size:
+        return size
+    with open_at(fasta_file, kind, offset) as fasta:
+        tail = b""
+        position = offset
+        for chunk in iter(lambda: fasta.read(65536), b""):
+            data = tail + chunk
+            header = data.find(b"\n>")
+            if header != -1:
+                return position - len(tail) + header + 1
+            tail = data[-1:]
+            position += len(chunk)
+    return size
+
+
+def iter_record_spans(data, start, end):
+    """Yields the (record start, header end, record end) offsets of every record that starts within the byte range,
+    the record end is the offset of the next header"""
+    position = data.find(b">", start, end)
+    while position != -1:
+        next_header = data.find(b"\n>", position, end)
+        record_end = end if next_header == -1 else next_header + 1
+        line_end = data.find(b"\n", position, record_end)
+        if line_end == -1:
+            line_end = record_end
+        yield position, line_end, record_end
+        position = -1 if next_header == -1 else record_end
+
+
+def record_bytes(data, span):
+    """Returns the header without '>' and the sequence without whitespace of the record span"""
+    position, line_end, record_end = span
+    return data[position + 1:line_end].rstrip(b"\r"), data[line_end + 1:record_end].translate(None, b"\r\n\t ")
+
+
+def iter_records(data, start, end):
+    """Yields the (header, sequence) bytes of every record that starts within the byte range of the mapped file"""
+    for span in iter_record_spans(data, start, end):
+        yield record_bytes(data, span)
+
+
+def iter_stream_chunks(stream, limit=UNBOUNDED):
+    """Reads a binary stream in large chunks and yields (chunk, offset, spans) for every chunk of complete records,
+    offset is the position of the chunk in the stream and spans are the record spans within the chunk.
+    Stops at the first record that starts at or after limit bytes"""
+    buffer = b""
+    offset = 0
+    while True:
+        data = stream.read(READ_SIZE)
+        buffer += data
+        # Without more data the rest of the buffer is the last record, otherwise it ends before the last header
+        complete = len(buffer) if not data else buffer.rfind(b"\n>") + 1
+        if complete > 0:
+            spans = []
+            for span in iter_record_spans(buffer, 0, complete):
+                if offset + span[0] >= limit:
+                    complete = 0
+                    break
+                spans.append(span)
+            yield buffer, offset, spans
+            if complete == 0:
+                return
+            buffer = buffer[complete:]
+            offset += complete
+        if not data:
+            return
+
+
+def iter_chunks(fasta_file, start=0, end=UNBOUNDED):
+    """Yields (data, offset, spans) for the records starting within the byte range of the uncompressed content. An
+    uncompressed file is memory-mapped as one chunk, compressed files are read in chunks of complete records"""
+    if start >= end:
+        return
+    kind = compression(fasta_file)
+    if kind is None:
+        with open(fasta_file, "rb") as fasta:
+            if os.fstat(fasta.fileno()).st_size == 0:
+                return
+            with mmap.mmap(fasta.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data, 0, iter_record_spans(data, start, min(end, len(data)))
+    elif kind == "bgzf":
+        with open_at(fasta_file, kind, start) as fasta:
+            for data, offset, spans in iter_stream_chunks(fasta, end - start):
+                yield data, start + offset, spans
+    else:
+        with open_fasta(fasta_file) as fasta:
+            yield from iter_stream_chunks(fasta, end)
+
+
+def read_byte_shard(fasta_file, start, end):
+    """Yields the (header, sequence) bytes of the records in the byte range of the fasta file"""
+    for data, _, spans in iter_chunks(fasta_file, start, end):
+        for span in spans:
+            yield record_bytes(data, span)
+
+
+def read_shard(fasta_file, start, end):
+    """Yields the (header, sequence) strings of the records in the byte range of the fasta file"""
+    for header, sequence in read_byte_shard(fasta_file, start, end):
+        yield header.decode("ascii", "replace"), sequence.decode("ascii", "replace")
+
+
+def read_records(fasta_file):
+    """Yields the (header, sequence) strings of every record of the fasta file"""
+    return read_shard(fasta_file, 0, UNBOUNDED)
+
+
+def record_names(name):
+    """Returns the names a record can be looked up by: the first word of its header and, for UniProt headers like
+    'sp|P69905|HBA_HUMAN', the accession"""
+    parts = name.split("|")
+    if len(parts) >= 3 and parts[0] in ("sp", "tr"):
+        return [name, parts[1]]
+    return [name]
+
+
+def record_accession(header):
+    """Returns the accession of a header: the UniProt accession when there is one, the first word otherwise"""
+    name = header.split(maxsplit=1)
+    return record_names(name[0].decode("ascii", "replace") if name else "")[-1]
+
+
+def build_fai(fasta_file):
+    """Returns the samtools style .fai entries of an uncompressed or BGZF file: name, sequence length, offset of the
+    sequence, bases per line and bytes per line of every record. The index is written next to the file when possible"""
+    entries = []
+    for data, offset, spans in iter_chunks(fasta_file):
+        for position, line_end, record_end in spans:
+            name = data[position + 1:line_end].split(maxsplit=1)
+            sequence = data[line_end + 1:record_end]
+            first_line = sequence.find(b"\n")
+            line_width = len(sequence) if first_line == -1 else first_line + 1
+            line_bases = len(sequence[:line_width].rstrip(b"\r\n"))
+            entries.append((name[0].decode("ascii", "replace") if name else "",
+                            len(sequence.translate(None, b"\r\n\t ")), offset + line_end + 1, line_bases, line_width))
+    try:
+        with open(fasta_file + ".fai", "w") as fai:
+            fai.writelines("\t".join(str(value) for value in entry) + "\n" for entry in entries)
+    except OSError:
+        pass
+    return entries
+
+
+def read_fai(fasta_file):
+    entries = []
+    with open(fasta_file + ".fai", "r") as fai:
+        for line in fai:
+            name, length, offset, line_bases, line_width = line.rstrip("\n").split("\t")[:5]
+            entries.append((name, int(length), int(offset), int(line_bases), int(line_width)))
+    return entries
+
+
+def load_fai(fasta_file):
+    """Returns the .fai index as a dict from record name and accession to (length, offset, line bases, line width),
+    the index is built first when it is missing or older than the fasta file"""
+    if compression(fasta_file) not in (None, "bgzf"):
+        raise ValueError("Random access needs an uncompressed or BGZF file, {} can only be streamed"
+                         .format(fasta_file))
+    if index_is_current(fasta_file + ".fai", fasta_file):
+        entries = read_fai(fasta_file)
+    else:
+        entries = build_fai(fasta_file)
+    index = {}
+    for name, length, offset, line_bases, line_width in entries:
+        for key in record_names(name):
+            index.setdefault(key, (length, offset, line_bases, line_width))
+    return index
+
+
+@contextmanager
+def map_fasta(fasta_file):
+    """Memory-maps an uncompressed fasta file for fetch_sequence, compressed and empty files give None"""
+    if compression(fasta_file) is not None or os.path.getsize(fasta_file) == 0:
+        yield None
+        return
+    with open(fasta_file, "rb") as fasta, mmap.mmap(fasta.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        yield data
+
+
+def fetch_sequence(fasta_file, name, index=None, data=None):
+    """Returns the sequence bytes of the record with the name or accession, or None when the index doesn't have it.
+    With the memory-mapped file of map_fasta the sequence is sliced from it instead of read from the file"""
+    if index is None:
+        index = load_fai(fasta_file)
+    entry = index.get(name)
+    if entry is None:
+        return None
+    length, offset, line_bases, line_width = entry
+    if data is not None:
+        end = data.find(b"\n>", offset)
+        return data[offset:len(data) if end == -1 else end].translate(None, b"\r\n\t ")[:length]
+
+    sequence = b""
+    # Lines that are shorter than the first line of the record just need more reads
+    byte_length = length // max(line_bases, 1) * line_width + length % max(line_bases, 1)
+    with open_at(fasta_file, compression(fasta_file), offset) as fasta:
+        while len(sequence) < length:
+            chunk = fasta.read(max(byte_length, 65536) if sequence else byte_length)
+            if not chunk:
+                break
+            sequence += chunk.translate(None, b"\r\n\t ")
+    return sequence[:length]
+
+
+def collect_sequences(fasta_file, names):
+    """Returns the sequence bytes of the records with the names or accessions in one pass over the file, for gzip and
+    zstd files that can't be indexed"""
+    sequences = {}
+    for header, sequence in read_byte_shard(fasta_file, 0, UNBOUNDED):
+        words = header.split(maxsplit=1)
+        for key in record_names(words[0].decode("ascii", "replace") if words else ""):
+            if key in names:
+                sequences.setdefault(key, sequence)
+    return sequences
+
+
+def main(argv):
+    print(' '.join(argv))
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-d', '--database', action='store', dest="database", required=True,
+                        help="Specify the uncompressed or BGZF fasta file to build the .fai index of")
+    args = parser.parse_args()
+
+    try:
+        print("Started at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
+        print("Indexed {} records".format(len({entry for entry in load_fai(args.database).values()})))
+        print("Finished at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
+    except FileNotFoundError as e:
+        print(__doc__)
+        print("Please provide valid files:")
+        print(e)
+        sys.exit(2)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
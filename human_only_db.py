@@ -2,23 +2,84 @@
 """
 Filters out any non human entries from a fasta database
 To be used to create a swissprot database with only Homo sapiens sequences
+Records are kept by the taxon ID in the OX= field of their header, any set of taxa can be given with --taxon.
+The database may be gzip, BGZF or zstd compressed, the filtered database is written uncompressed.
 """
 import argparse
 import datetime
 import os
+import re
+import shutil
 import sys
 
-from Bio import SeqIO
+import fasta_reader
+import stage_scheduler
 
+HUMAN_TAXON = "9606"
+TAXON_PATTERN = re.compile(rb" OX=(\d+)")
+WRITE_BUFFER = 8 * 1024 ** 2
 
-def search_db(db_file):
-    filename = os.path.splitext(db_file)[0]
-    output = "{}.human.fasta".format(filename)
-    with open(output, "w") as out_file:
-        with open(db_file, "r") as database:
-            for record in SeqIO.parse(database, "fasta"):
-                if "Homo sapiens" in record.description:
-                    SeqIO.write(record, out_file, "fasta")
+
+def filtered_file(db_file, taxa):
+    """Returns the output file of the database filtered on the taxa"""
+    filename = os.path.splitext(fasta_reader.strip_compression(db_file))[0]
+    if set(taxa) == {HUMAN_TAXON}:
+        return "{}.human.fasta".format(filename)
+    return "{}.{}.fasta".format(filename, "_".join(sorted(taxa)))
+
+
+def filter_shard(shard):
+    """Copies the records of a byte range of the database whose taxon is in the set to the part file, the header
+    decides and runs of consecutive matching records are copied as raw bytes in one write"""
+    db_file, start, end, taxa, part_file = shard
+    kept = 0
+    with open(part_file, "wb", buffering=WRITE_BUFFER) as out_file:
+        for data, _, spans in fasta_reader.iter_chunks(db_file, start, end):
+            view = memoryview(data)
+            run_start = run_end = None
+            for position, line_end, record_end in spans:
+                taxon = TAXON_PATTERN.search(data, position, line_end)
+                if taxon is None or taxon.group(1) not in taxa:
+                    continue
+                kept += 1
+                if position != run_end:
+                    if run_start is not None:
+                        out_file.write(view[run_start:run_end])
+                    run_start = position
+                run_end = record_end
+            if run_start is not None:
+                out_file.write(view[run_start:run_end])
+                # The last record of the file may miss its line ending
+                if data[run_end - 1:run_end] != b"\n":
+                    out_file.write(b"\n")
+            view.release()
+    return kept
+
+
+def search_db(db_file, taxa=(HUMAN_TAXON,), cpu=None, output=None):
+    """Writes the records of the taxa to a new fasta file, with the database split over <cpu> byte ranges that are
+    filtered in parallel and joined in order. Returns the number of records kept"""
+    if cpu is None:
+        cpu = os.cpu_count()
+    if output is None:
+        output = filtered_file(db_file, taxa)
+    taxa = {str(taxon).encode() for taxon in taxa}
+    shards = [(db_file, start, end, taxa, "{}.part{}".format(output, number))
+              for number, (start, end) in enumerate(fasta_reader.shard_offsets(db_file, cpu))]
+    try:
+        with stage_scheduler.pool_context().Pool(processes=cpu) as pool:
+            kept = sum(pool.map(filter_shard, shards))
+        with open(output, "wb") as out_file:
+            for shard in shards:
+                with open(shard[-1], "rb") as part:
+                    shutil.copyfileobj(part, out_file, WRITE_BUFFER)
+    finally:
+        for shard in shards:
+            try:
+                os.remove(shard[-1])
+            except FileNotFoundError:
+                pass
+    return kept
 
 
 def main(argv):
@@ -27,10 +88,17 @@ def main(argv):
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-d', '--database', action='store', dest="database", required=True,
                         help="Specify the directory of the protein database file")
+    parser.add_argument('-t', '--taxon', action='append', dest="taxa",
+                        help="Specify an NCBI taxon ID to keep, can be given multiple times (default 9606, human)")
+    parser.add_argument('-o', '--output', action='store', dest="output",
+                        help="Specify the filtered fasta file, by default <database>.human.fasta")
+    parser.add_argument('--cpu', action='store', dest="cpu", type=int,
+                        help="Provide number of CPUs to filter the database with")
     args = parser.parse_args()
     try:
         print("Started at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
-        search_db(args.database)
+        kept = search_db(args.database, args.taxa or (HUMAN_TAXON,), args.cpu, args.output)
+        print("Kept {} records".format(kept))
         print("Finished at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
     except FileNotFoundError as e:
         print(__doc__)
@@ -40,4 +108,4 @@ def main(argv):
 
 
 if __name__ == '__main__':
-    main(sys.argv)
\ No newline at end of file
+    main(sys.argv)
@@ -1,37 +1,90 @@
 #!/usr/bin/python3
 """
 Module that converts cds sequences of orf_finder output to pep.
+Codons are translated through a NumPy lookup table. With --frames 3 or 6 every transcript is translated in its three
+forward frames, or all six frames, to build a custom proteogenomic database without an ORF caller.
+Run it from the repository root with 'python -m lst_to_fasta_converter.cds_to_pep'.
 """
 
+import argparse
 import datetime
+import os
+import sys
+
+import numpy as np
+
+import fasta_reader
+
+CDS_FILE = "output/Trinity.fasta.genemark.cds"
+PEP_FILE = "output/Trinity.fasta.genemark.pep"
+WRITE_BUFFER = 8 * 1024 ** 2
+
+CODONS = {
+    'ATA': 'I', 'ATC': 'I', 'ATT': 'I', 'ATG': 'M',
+    'ACA': 'T', 'ACC': 'T', 'ACG': 'T', 'ACT': 'T',
+    'AAC': 'N', 'AAT': 'N', 'AAA': 'K', 'AAG': 'K',
+    'AGC': 'S', 'AGT': 'S', 'AGA': 'R', 'AGG': 'R',
+    'CTA': 'L', 'CTC': 'L', 'CTG': 'L', 'CTT': 'L',
+    'CCA': 'P', 'CCC': 'P', 'CCG': 'P', 'CCT': 'P',
+    'CAC': 'H', 'CAT': 'H', 'CAA': 'Q', 'CAG': 'Q',
+    'CGA': 'R', 'CGC': 'R', 'CGG': 'R', 'CGT': 'R',
+    'GTA': 'V', 'GTC': 'V', 'GTG': 'V', 'GTT': 'V',
+    'GCA': 'A', 'GCC': 'A', 'GCG': 'A', 'GCT': 'A',
+    'GAC': 'D', 'GAT': 'D', 'GAA': 'E', 'GAG': 'E',
+    'GGA': 'G', 'GGC': 'G', 'GGG': 'G', 'GGT': 'G',
+    'TCA': 'S', 'TCC': 'S', 'TCG': 'S', 'TCT': 'S',
+    'TTC': 'F', 'TTT': 'F', 'TTA': 'L', 'TTG': 'L',
+    'TAC': 'Y', 'TAT': 'Y', 'TAA': '*', 'TAG': '*',
+    'TGC': 'C', 'TGT': 'C', 'TGA': '*', 'TGG': 'W',
+}
+
+# Bases are coded 0-3, anything else is 4, so a codon is a number below 125 and codons with an unknown base are X
+BASE_CODES = np.full(256, 4, dtype=np.int16)
+for code, base in enumerate("ACGT"):
+    BASE_CODES[ord(base)] = BASE_CODES[ord(base.lower())] = code
+COMPLEMENT_CODES = np.array([3, 2, 1, 0, 4], dtype=np.int16)
+CODON_TABLE = np.full(125, ord("X"), dtype=np.uint8)
+for codon, amino_acid in CODONS.items():
+    CODON_TABLE[25 * BASE_CODES[ord(codon[0])] + 5 * BASE_CODES[ord(codon[1])] + BASE_CODES[ord(codon[2])]] = \
+        ord(amino_acid)
+
+
+def encode(sequence):
+    """Converts a nucleotide sequence into an array of base codes"""
+    if isinstance(sequence, str):
+        sequence = sequence.encode("ascii", "replace")
+    return BASE_CODES[np.frombuffer(sequence, dtype=np.uint8)]
+
+
+def codon_indices(codes):
+    """Returns the codon table index of the codon starting at every position of the base codes"""
+    if len(codes) < 3:
+        return np.empty(0, dtype=np.int16)
+    return 25 * codes[:-2] + 5 * codes[1:-1] + codes[2:]
 
 
 def translate(sequence):
-    table = {
-        'ATA': 'I', 'ATC': 'I', 'ATT': 'I', 'ATG': 'M',
-        'ACA': 'T', 'ACC': 'T', 'ACG': 'T', 'ACT': 'T',
-        'AAC': 'N', 'AAT': 'N', 'AAA': 'K', 'AAG': 'K',
-        'AGC': 'S', 'AGT': 'S', 'AGA': 'R', 'AGG': 'R',
-        'CTA': 'L', 'CTC': 'L', 'CTG': 'L', 'CTT': 'L',
-        'CCA': 'P', 'CCC': 'P', 'CCG': 'P', 'CCT': 'P',
-        'CAC': 'H', 'CAT': 'H', 'CAA': 'Q', 'CAG': 'Q',
-        'CGA': 'R', 'CGC': 'R', 'CGG': 'R', 'CGT': 'R',
-        'GTA': 'V', 'GTC': 'V', 'GTG': 'V', 'GTT': 'V',
-        'GCA': 'A', 'GCC': 'A', 'GCG': 'A', 'GCT': 'A',
-        'GAC': 'D', 'GAT': 'D', 'GAA': 'E', 'GAG': 'E',
-        'GGA': 'G', 'GGC': 'G', 'GGG': 'G', 'GGT': 'G',
-        'TCA': 'S', 'TCC': 'S', 'TCG': 'S', 'TCT': 'S',
-        'TTC': 'F', 'TTT': 'F', 'TTA': 'L', 'TTG': 'L',
-        'TAC': 'Y', 'TAT': 'Y', 'TAA': '*', 'TAG': '*',
-        'TGC': 'C', 'TGT': 'C', 'TGA': '*', 'TGG': 'W',
-    }
-    protein = ""
+    """Translates a cds, which has to be a whole number of codons, or returns an empty protein"""
     seq = sequence.rstrip()
-    if len(seq) % 3 == 0:
-        for i in range(0, len(seq), 3):
-            codon = seq[i:i + 3]
-            protein += table[codon]
-    return protein
+    if len(seq) % 3 != 0:
+        return ""
+    codes = encode(seq).reshape(-1, 3)
+    return CODON_TABLE[25 * codes[:, 0] + 5 * codes[:, 1] + codes[:, 2]].tobytes().decode("ascii")
+
+
+def translate_frames(sequence, frames=6):
+    """Translates the first 3 (forward) or all 6 reading frames of a sequence, returns (frame, protein) pairs with
+    frames named +1, +2, +3, -1, -2 and -3. Each strand is looked up in one pass over all of its codons"""
+    codes = encode(sequence)
+    strands = [("+", codes)]
+    if frames == 6:
+        strands.append(("-", COMPLEMENT_CODES[codes[::-1]]))
+    proteins = []
+    for strand, strand_codes in strands:
+        amino_acids = CODON_TABLE[codon_indices(strand_codes)]
+        for frame in range(3):
+            proteins.append(("{}{}".format(strand, frame + 1), amino_acids[frame::3].tobytes().decode("ascii")))
+    return proteins
 
 
 def insert_newlines(seq, every=60):
@@ -42,34 +95,52 @@ def insert_newlines(seq, every=60):
     return '\n'.join(lines)
 
 
-def parse_cds_fasta(file):
+def pep_records(header, sequence, frames=1):
+    """Returns the (header, protein) records of a cds: the cds translated as is, or its 3 or 6 reading frames with the
+    frame added to the record name"""
+    if frames == 1:
+        return [(header, translate(sequence))]
+    name, _, description = header.partition(" ")
+    return [("{}_frame{}{}".format(name, frame, " " + description if description else ""), protein)
+            for frame, protein in translate_frames(sequence, frames)]
+
+
+def parse_cds_fasta(file, output_file=PEP_FILE, frames=1):
     """Extracts cds data to convert and write to pep fasta file"""
-    with open("output/Trinity.fasta.genemark.pep", "w+") as new_file:
+    with open(output_file, "w", buffering=WRITE_BUFFER) as new_file:
+        for header, sequence in fasta_reader.read_records(file):
+            for pep_header, pep in pep_records(header, sequence, frames):
+                new_file.write(">{}\n{}\n".format(pep_header, insert_newlines(pep)))
+
 
-        with open(file, "r") as f:
-            sequence = ""
-            for line in f:
-                if line.startswith(">"):
-                    if sequence:
-                        pep = translate(sequence)
-                        fasta_pep = insert_newlines(pep)
-                        new_file.write(fasta_pep + "\n")
-                    sequence = ""
-                    header = line
-                    new_file.write(header)
-                else:
-                    sequence += line.rstrip()
-            pep = translate(sequence)
-            fasta_pep = insert_newlines(pep)
-            new_file.write(fasta_pep + "\n")
+def main(argv):
+    print(' '.join(argv))
 
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-c', '--cds', action="store", dest="cds", default=CDS_FILE,
+                        help="Specify the cds fasta file written by orf_finder, or any nucleotide fasta file")
+    parser.add_argument('-o', '--output', action="store", dest="output", default=PEP_FILE,
+                        help="Specify the peptide fasta file to write")
+    parser.add_argument('--frames', action="store", dest="frames", type=int, choices=[1, 3, 6], default=1,
+                        help="Translate every sequence as is (1), in its three forward frames (3) or in all six "
+                             "frames (6)")
+    args = parser.parse_args()
 
-def main():
+    try:
+        os.makedirs(os.path.dirname(args.output) or ".")
+    except FileExistsError:
+        pass
 
-    print("Started at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
-    parse_cds_fasta("output/Trinity.fasta.genemark.cds")
-    print("Finished at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
+    try:
+        print("Started at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
+        parse_cds_fasta(args.cds, args.output, args.frames)
+        print("Finished at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
+    except FileNotFoundError as e:
+        print(__doc__)
+        print("Please provide valid files:")
+        print(e)
+        sys.exit(2)
 
 
 if __name__ == '__main__':
-    main()
+    main(sys.argv)
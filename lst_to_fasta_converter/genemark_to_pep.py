@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+"""
+Builds a peptide fasta database straight from the GeneMarkS-T .lst file and the Trinity RNA transcripts, fusing
+orf_finder and cds_to_pep. Chunks of transcripts are extracted and translated by worker processes and written in
+order, the cds file is only written when asked for.
+Run it from the repository root with 'python -m lst_to_fasta_converter.genemark_to_pep'.
+"""
+
+import argparse
+import datetime
+import os
+import sys
+from contextlib import ExitStack
+from functools import partial
+
+from lst_to_fasta_converter import cds_to_pep, orf_finder
+
+
+def translate_chunk(transcripts, with_cds=False):
+    """Extracts the ORFs of a chunk of transcripts and translates them. Returns the peptide fasta text, the cds fasta
+    text when with_cds is set and the accessions of the transcripts that weren't found"""
+    records, missing = orf_finder.orf_records(transcripts, orf_finder.worker_state["find_sequence"])
+    pep = "".join(">{}\n{}\n".format(header, cds_to_pep.insert_newlines(cds_to_pep.translate(orf)))
+                  for header, orf in records)
+    cds = "".join(">{}\n{}\n".format(header, orf_finder.insert_newlines(orf)) for header, orf in records) \
+        if with_cds else None
+    return pep, cds, missing
+
+
+def build_peptide_db(gm_file, trans_file, output_file=cds_to_pep.PEP_FILE, cds_file=None, cpu=None):
+    """Writes the translated ORFs of the genemark file to the peptide fasta file, and their cds to cds_file when it
+    is given"""
+    with ExitStack() as files:
+        pep_output = files.enter_context(open(output_file, "w", buffering=orf_finder.WRITE_BUFFER))
+        cds_output = None if cds_file is None else \
+            files.enter_context(open(cds_file, "w", buffering=orf_finder.WRITE_BUFFER))
+        for pep, cds, missing in orf_finder.run_chunks(partial(translate_chunk, with_cds=cds_file is not None),
+                                                        gm_file, trans_file, cpu):
+            for gene_id in missing:
+                print("Transcript {} not found in {}".format(gene_id, trans_file))
+            pep_output.write(pep)
+            if cds_output is not None:
+                cds_output.write(cds)
+
+
+def main(argv):
+    print(' '.join(argv))
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-g', '--genemark', action="store", dest="genemark", required=True,
+                        help="Specify the directory of the GenemarkS-T .lst file")
+    parser.add_argument('-t', '--transcript', action="store", dest="transcript", required=True,
+                        help="Specify the directory of the Trinity RNA transcript fasta file")
+    parser.add_argument('-o', '--output', action="store", dest="output", default=cds_to_pep.PEP_FILE,
+                        help="Specify the peptide fasta file to write")
+    parser.add_argument('--cds', action="store", dest="cds",
+                        help="Also write the cds of the ORFs to this fasta file")
+    parser.add_argument('--cpu', action='store', dest="cpu", type=int,
+                        help="Provide number of CPUs to extract and translate the ORFs with")
+    args = parser.parse_args()
+
+    for output_file in (args.output, args.cds):
+        if output_file is not None:
+            try:
+                os.makedirs(os.path.dirname(output_file) or ".")
+            except FileExistsError:
+                pass
+
+    try:
+        print("Started at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
+        build_peptide_db(args.genemark, args.transcript, args.output, args.cds, args.cpu)
+        print("Finished at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
+    except FileNotFoundError as e:
+        print(__doc__)
+        print("Please provide valid files:")
+        print(e)
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
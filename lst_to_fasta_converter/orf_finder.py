@@ -1,29 +1,36 @@
 #!/usr/bin/python3
 """short python module to extract ORFs found with GeneMarkS-T from the RNA transcripts assembled by Trinity.
+The transcript file may be gzip, BGZF or zstd compressed. Run it from the repository root with
+'python -m lst_to_fasta_converter.orf_finder'.
 """
 
 import argparse
 import datetime
+import multiprocessing as mp
 import os
 import sys
+from contextlib import ExitStack
+from functools import partial
+from itertools import islice
 
-nuc_dict = {
-    "A": "T",
-    "T": "A",
-    "C": "G",
-    "G": "C"
-}
+import fasta_reader
 
+CDS_FILE = "output/Trinity.fasta.genemark.cds"
+# Transcripts handed to a worker at once
+GENE_CHUNK_SIZE = 1000
+WRITE_BUFFER = 8 * 1024 ** 2
+COMPLEMENT = bytes.maketrans(b"ATCG", b"TAGC")
 
-def find_fasta_line(trans_file, accession):
-    """Finds the right RNA transcript using the TRINITY gene accession found in the lst file"""
-    with open(trans_file, "r") as inF:
-        for line in inF:
-            if accession in line:
-                if line.startswith(">"):
-                    sequence = next(inF)
-                    return sequence
-    return 0
+worker_state = {}
+
+
+def transcript_lookup(trans_file, accessions, data=None):
+    """Returns a function giving the transcript sequence bytes of an accession, or None when it isn't found.
+    Uncompressed and BGZF files are looked up through their .fai offset index, optionally in the memory-mapped file
+    of fasta_reader.map_fasta. The transcripts of the accessions in gzip and zstd files are collected in one pass"""
+    if fasta_reader.compression(trans_file) in (None, "bgzf"):
+        return partial(fasta_reader.fetch_sequence, trans_file, index=fasta_reader.load_fai(trans_file), data=data)
+    return fasta_reader.collect_sequences(trans_file, set(accessions)).get
 
 
 def extract_gene_id(line):
@@ -43,18 +50,8 @@ def find_transcript_position(info_line):
 
 
 def reverse_complement(sequence):
-    """Converts sequence to reverse complement"""
-    bases = list(sequence)
-    bases = reversed([nuc_dict.get(base, base) for base in bases])
-    new_sequence = ''.join(bases)
-    return new_sequence
-
-
-def write_orfs(gene_id, sequence, start, stop, strand):
-    """Writes ORFs to new file in current directory"""
-    with open("output/Trinity.fasta.genemark.cds", "a+") as new_file:
-        new_file.write(">" + gene_id + ":" + str(start+1) + "-" + str(stop) + "(" + strand + ")\n")
-        new_file.write(sequence + "\n")
+    """Converts sequence bytes to their reverse complement"""
+    return sequence.translate(COMPLEMENT)[::-1]
 
 
 def insert_newlines(seq, every=60):
@@ -65,26 +62,100 @@ def insert_newlines(seq, every=60):
     return '\n'.join(lines)
 
 
-def parse_genemark(gm_file, trans_file):
-    """Parses through genemark file to extract info for each transcript"""
+def parse_lst(gm_file):
+    """Lazily yields (gene accession, ORFs) for every transcript in the genemark file, ORFs holds the
+    (strand, start, stop) of every gene predicted in the transcript"""
+    gene_id = None
+    orfs = []
     with open(gm_file, "r") as f:
-        lines = f.readlines()
-        for index, line in enumerate(lines):
+        for line in f:
             if 'FASTA' in line:
+                if gene_id is not None:
+                    yield gene_id, orfs
                 gene_id = extract_gene_id(line)
-                sequence = find_fasta_line(trans_file, gene_id)
-                try:
-                    info_line = lines[index + 4]
-                    if info_line.strip():
-                        strand, start_pos, stop_pos = find_transcript_position(info_line)
-                        sequence = sequence[start_pos:stop_pos]
-                        if strand == "-":
-                            sequence = reverse_complement(sequence)
-                        sequence = insert_newlines(sequence)
-                        write_orfs(gene_id, sequence, start_pos, stop_pos, strand)
-
-                except IndexError:
-                    pass
+                orfs = []
+            elif gene_id is not None:
+                # Gene rows start with the gene number, the table header rows don't
+                columns = line.split()
+                if len(columns) >= 4 and columns[0].isdigit():
+                    orfs.append(find_transcript_position(line))
+    if gene_id is not None:
+        yield gene_id, orfs
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    return iter(lambda: list(islice(iterator, size)), [])
+
+
+def orf_records(transcripts, find_sequence):
+    """Returns the (header, sequence) of the ORFs of the transcripts, followed by the accessions of the transcripts
+    that weren't found"""
+    records = []
+    missing = []
+    for gene_id, orfs in transcripts:
+        # A transcript without predicted genes doesn't need its sequence
+        if not orfs:
+            continue
+        sequence = find_sequence(gene_id)
+        if sequence is None:
+            missing.append(gene_id)
+            continue
+        for strand, start, stop in orfs:
+            orf = sequence[start:stop]
+            if strand == "-":
+                orf = reverse_complement(orf)
+            records.append(("{}:{}-{}({})".format(gene_id, start + 1, stop, strand), orf.decode("ascii", "replace")))
+    return records, missing
+
+
+def init_worker(trans_file, sequences=None):
+    """Pool initializer that opens the transcript lookup once per worker, sequences holds the collected transcripts
+    of a gzip or zstd file"""
+    if sequences is not None:
+        worker_state["find_sequence"] = sequences.get
+        return
+    # The memory map stays open for the lifetime of the worker
+    worker_state["files"] = ExitStack()
+    data = worker_state["files"].enter_context(fasta_reader.map_fasta(trans_file))
+    worker_state["find_sequence"] = transcript_lookup(trans_file, (), data)
+
+
+def extract_chunk(transcripts):
+    """Formats the ORFs of a chunk of transcripts as fasta text"""
+    records, missing = orf_records(transcripts, worker_state["find_sequence"])
+    return "".join(">{}\n{}\n".format(header, insert_newlines(orf)) for header, orf in records), missing
+
+
+def run_chunks(function, gm_file, trans_file, cpu=None):
+    """Yields the results of the function for chunks of transcripts of the genemark file in order, with the chunks
+    spread over <cpu> worker processes"""
+    if cpu is None:
+        cpu = os.cpu_count()
+    sequences = None
+    if fasta_reader.compression(trans_file) in (None, "bgzf"):
+        # Building the offset index once up front saves every worker from building it
+        fasta_reader.load_fai(trans_file)
+    else:
+        sequences = fasta_reader.collect_sequences(trans_file,
+                                                   {gene_id for gene_id, orfs in parse_lst(gm_file) if orfs})
+
+    chunks = chunked(parse_lst(gm_file), GENE_CHUNK_SIZE)
+    if cpu == 1:
+        init_worker(trans_file, sequences)
+        yield from map(function, chunks)
+        return
+    with mp.Pool(processes=cpu, initializer=init_worker, initargs=(trans_file, sequences)) as pool:
+        yield from pool.imap(function, chunks)
+
+
+def parse_genemark(gm_file, trans_file, output_file=CDS_FILE, cpu=None):
+    """Parses through genemark file to extract the ORFs of each transcript, written in order by one buffered writer"""
+    with open(output_file, "w", buffering=WRITE_BUFFER) as new_file:
+        for text, missing in run_chunks(extract_chunk, gm_file, trans_file, cpu):
+            for gene_id in missing:
+                print("Transcript {} not found in {}".format(gene_id, trans_file))
+            new_file.write(text)
 
 
 def main(argv):
@@ -95,6 +166,8 @@ def main(argv):
                         help="Specify the directory of the GenemarkS-T protein-peptides.csv file")
     parser.add_argument('-t', '--transcript', action="store", dest="transcript", required=True,
                         help="Specify the directory of the Trinity RNA transcript fasta file")
+    parser.add_argument('--cpu', action='store', dest="cpu", type=int,
+                        help="Provide number of CPUs to extract the ORFs with")
     args = parser.parse_args()
 
     try:
@@ -102,12 +175,9 @@ def main(argv):
     except FileExistsError:
         pass
 
-    if os.path.exists("output/Trinity.fasta.genemark.cds"):
-        os.remove("output/Trinity.fasta.genemark.cds")
-
     try:
         print("Started at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
-        parse_genemark(args.genemark, args.transcript)
+        parse_genemark(args.genemark, args.transcript, cpu=args.cpu)
         print("Finished at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
     except FileNotFoundError as e:
         print(__doc__)
@@ -1,38 +1,107 @@
 #!/usr/bin/python3
 """Short module to compare two PEAKS psm protein-peptide output files to find overlap and distinction between the two
     in terms of matched peptides. Distinct peptides of each file will be stored in separate files.
+    More groups can be compared at once, which also gives the UpSet table of all group intersections.
 """
 import argparse
 import datetime
 import os
 import sys
 
+import numpy as np
 import pandas
 
 import csv_dataframe
+from peptide_table import PeptideTable
 
+MAX_GROUPS = 64
 
-def find_distinct_peptides(left_data, right_data, prefix, left_name, right_name, output_dir):
-    """Filters the CSV files so only distinct peptides remain"""
-    distinct_left_csv = "output/{}/comparison_output/{}_distinct_{}.csv".format(output_dir, prefix, left_name)
-    distinct_right_csv = "output/{}/comparison_output/{}_distinct_{}.csv".format(output_dir, prefix, right_name)
-    with open(distinct_left_csv, "w+") as distinct_left, \
-            open(distinct_right_csv, "w+") as distinct_right:
-        left_merged = pandas.merge(left_data, right_data, on='Peptide', how='left', indicator=True) \
-            .query("_merge == 'left_only'")
-        right_merged = pandas.merge(left_data, right_data, on='Peptide', how='right', indicator=True) \
-            .query("_merge == 'right_only'")
-        left_merged[['Peptide']] \
-            .to_csv(distinct_left, sep=',', mode='w', index=False, header=['Peptide'],
-                    line_terminator='\n')
-        right_merged[['Peptide']] \
-            .to_csv(distinct_right, sep=',', mode='w', index=False, header=['Peptide'],
-                    line_terminator='\n')
-    with open("output/{}/comparison_output/{}_common_peps.csv".format(output_dir, prefix), "w+") as commons:
-        common_peps = pandas.merge(left_data, right_data, on='Peptide', how='outer', indicator=True) \
-            .query("_merge == 'both'")
-        common_peps[['Peptide']]\
-            .to_csv(commons, sep=',', mode='w', index=False, header=['Peptide'], line_terminator='\n')
+
+def compare_groups(groups):
+    """Interns the peptides of all group PeptideTables to one set of integer IDs. Returns the table of all peptides,
+    the peptide IDs of every group and per peptide ID a bitmask of the groups containing it (bit i is group i)"""
+    if len(groups) > MAX_GROUPS:
+        raise ValueError("At most {} groups can be compared at once".format(MAX_GROUPS))
+    sizes = [len(group) for group in groups]
+    vocabulary = PeptideTable.concat(groups)
+    ids = np.split(vocabulary.ids, np.cumsum(sizes)[:-1])
+
+    masks = np.zeros(vocabulary.sequence_count(), dtype=np.uint64)
+    for bit, group_ids in enumerate(ids):
+        masks[group_ids] |= np.uint64(1) << np.uint64(bit)
+    return vocabulary, ids, masks
+
+
+def find_distinct_peptides(left_data, right_data):
+    """Filters the peptide tables so only distinct peptides remain, returns the peptides only found in the left
+    table, only found in the right table and found in both"""
+    vocabulary, (left_ids, right_ids), masks = compare_groups([left_data, right_data])
+    left_masks = masks[left_ids]
+    right_masks = masks[right_ids]
+    return (left_data[left_masks == 1].reset_index(),
+            right_data[right_masks == 2].reset_index(),
+            left_data[left_masks == 3].reset_index())
+
+
+def find_exclusive_peptides(groups):
+    """Returns per group the peptides found only in that group, followed by the peptides found in all groups"""
+    vocabulary, ids, masks = compare_groups(groups)
+    all_groups = np.uint64((1 << len(groups)) - 1)
+    exclusive = [group[masks[group_ids] == (np.uint64(1) << np.uint64(bit))].reset_index()
+                 for bit, (group, group_ids) in enumerate(zip(groups, ids))]
+    common = groups[0][masks[ids[0]] == all_groups].reset_index()
+    return exclusive + [common]
+
+
+def intersection_table(groups, names):
+    """Creates the UpSet table: one row per combination of groups that share peptides, with the number of peptides
+    found in exactly that combination of groups"""
+    vocabulary, ids, masks = compare_groups(groups)
+    combinations, counts = np.unique(masks, return_counts=True)
+    table = pandas.DataFrame({name: (combinations >> np.uint64(bit)) & np.uint64(1) == 1
+                              for bit, name in enumerate(names)}, columns=names)
+    table['Degree'] = table[names].sum(axis=1)
+    table['Peptides'] = counts
+    return table.sort_values(by=['Peptides', 'Degree'], ascending=[False, True]).reset_index(drop=True)
+
+
+def distinct_peptide_files(prefix, left_name, right_name, output_dir):
+    """Returns the CSV files of the left distinct, right distinct and common peptides"""
+    return ("output/{}/comparison_output/{}_distinct_{}.csv".format(output_dir, prefix, left_name),
+            "output/{}/comparison_output/{}_distinct_{}.csv".format(output_dir, prefix, right_name),
+            "output/{}/comparison_output/{}_common_peps.csv".format(output_dir, prefix))
+
+
+def write_distinct_peptides(distinct_peptides, prefix, left_name, right_name, output_dir):
+    """Writes the tables of find_distinct_peptides to CSV files"""
+    for peptides, output_file in zip(distinct_peptides,
+                                     distinct_peptide_files(prefix, left_name, right_name, output_dir)):
+        with open(output_file, "w+") as output:
+            peptides.to_frame().to_csv(output, sep=',', mode='w', index=False, header=['Peptide'],
+                                       line_terminator='\n')
+
+
+def read_distinct_peptides(prefix, left_name, right_name, output_dir):
+    """Reads the tables written by write_distinct_peptides back in"""
+    return tuple(csv_dataframe.load_peptide_table(output_file)
+                 for output_file in distinct_peptide_files(prefix, left_name, right_name, output_dir))
+
+
+def write_group_comparison(groups, names, prefix, output_dir):
+    """Writes the exclusive peptides of every group, the peptides common to all groups and the UpSet table"""
+    exclusive = find_exclusive_peptides(groups)
+    output_files = ["output/{}/comparison_output/{}_distinct_{}.csv".format(output_dir, prefix, name)
+                    for name in names] + ["output/{}/comparison_output/{}_common_peps.csv".format(output_dir, prefix)]
+    for peptides, output_file in zip(exclusive, output_files):
+        with open(output_file, "w+") as output:
+            peptides.to_frame().to_csv(output, sep=',', mode='w', index=False, header=['Peptide'],
+                                       line_terminator='\n')
+    write_intersection_table(groups, names, prefix, output_dir)
+
+
+def write_intersection_table(groups, names, prefix, output_dir):
+    with open("output/{}/comparison_output/{}_upset.csv".format(output_dir, prefix), "w+") as output:
+        intersection_table(groups, names).to_csv(output, sep=',', mode='w', index=False, line_terminator='\n')
 
 
 def main(argv):
@@ -45,6 +114,10 @@ def main(argv):
     parser.add_argument('-r', '--right', action='store', dest="right",
                         help="Specify the .txt file containing the second group of peptide .csv file paths",
                         required=True)
+    parser.add_argument('-g', '--group', action='append', dest="groups", default=[],
+                        help="Add another group to compare as <NAME>=<.txt file>, can be given multiple times")
+    parser.add_argument('--upset', action='store_true', dest="upset",
+                        help="Also write the UpSet table of the group intersections for two groups")
     parser.add_argument('--left_name', action='store', dest="left_name", default="left",
                         help="Name the left sample")
     parser.add_argument('--right_name', action='store', dest="right_name", default="right",
@@ -69,7 +142,20 @@ def main(argv):
         left_data = csv_dataframe.join_dataframes(args.left)
         right_data = csv_dataframe.join_dataframes(args.right)
 
-        find_distinct_peptides(left_data, right_data, args.prefix, args.left_name, args.right_name, args.outdir)
+        if args.groups:
+            names = [args.left_name, args.right_name]
+            groups = [left_data, right_data]
+            for group in args.groups:
+                name, _, data = group.partition("=")
+                names.append(name)
+                groups.append(csv_dataframe.join_dataframes(data))
+            write_group_comparison(groups, names, args.prefix, args.outdir)
+        else:
+            distinct_peptides = find_distinct_peptides(left_data, right_data)
+            write_distinct_peptides(distinct_peptides, args.prefix, args.left_name, args.right_name, args.outdir)
+            if args.upset:
+                write_intersection_table([left_data, right_data], [args.left_name, args.right_name], args.prefix,
+                                         args.outdir)
         print("Finished at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
     except FileNotFoundError as e:
         print(__doc__)
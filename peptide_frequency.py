@@ -2,84 +2,338 @@
 """
 A python module that counts and compares peptide frequency between two groups. Results can be found in a separate
 output file.
-Contains a Mann-Whitney U test
+The counts of all samples are stored as one sparse peptide x sample matrix, the per group CSV files with a column per
+sample are only written on request.
+Contains a Mann-Whitney U test and a permutation test of the difference in mean frequency between the groups
 """
 import argparse
 import datetime
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
+import scipy.sparse as sparse
 import scipy.stats as stats
 import statsmodels.stats.multitest as sm
 
 import csv_dataframe
+import table_cache
 
+# Peptides per chunk of the Mann-Whitney U test, each chunk is ranked in one go by a worker process
+TEST_CHUNK_SIZE = 20000
+# Label permutations evaluated at once for all peptides
+PERMUTATION_BATCH_SIZE = 500
+# Peptides x permutations evaluated by a worker at once, bounds the dense arrays of a batch to 32 MB each
+PERMUTATION_CELLS = 2 ** 22
+# A peptide stops being permuted once this many permutations were at least as extreme as the observed difference
+PERMUTATION_STOP_HITS = 20
 
-def count_peptide_frequency(peptide_data, column_name):
-    """Counts amount of PSMs per peptide"""
-    count = pd.DataFrame(peptide_data['Peptide'].value_counts().reset_index())
-    count.columns = ['Peptide', column_name]
-    return count
+permutation_state = {}
 
 
-def parts_per_million(data):
-    """Converts dataframe values to parts per million across the columns"""
-    data_sum = data.sum()
-    ppm = data / data_sum * 1000000
-    return ppm
+def build_count_matrix(groups, vocabulary=None):
+    """Counts the PSMs per peptide of every sample in one pass over the files of all groups. groups holds
+    (group name, .txt file) pairs. Returns the peptide vocabulary shared by the groups, the sample column names, the
+    group of every sample and a sparse peptide x sample CSC matrix of the counts.
+    Peptides are numbered in order of first appearance, after the peptides of the vocabulary when one is given"""
+    columns = []
+    sample_groups = []
+    peptides = []
+    for group_name, files in groups:
+        for num, file in enumerate(csv_dataframe.list_csv_files(files)):
+            peptides.append(csv_dataframe.extract_csv_data(file, drop_dupes=False)['Peptide'])
+            columns.append("{}{}".format(group_name, num + 1))
+            sample_groups.append(group_name)
+    all_psms = pd.concat(peptides, ignore_index=True) if peptides else pd.Series([], dtype=object)
+    samples = np.repeat(np.arange(len(peptides)), [len(sample) for sample in peptides])
 
+    if vocabulary is None:
+        codes, vocabulary = pd.factorize(all_psms)
+        vocabulary = pd.Index(vocabulary, dtype=object)
+    else:
+        vocabulary = pd.Index(vocabulary, dtype=object)
+        codes = vocabulary.get_indexer(all_psms)
+        unseen = (codes == -1) & all_psms.notna().values
+        if unseen.any():
+            vocabulary = vocabulary.append(pd.Index(pd.unique(all_psms[unseen]), dtype=object))
+            codes = vocabulary.get_indexer(all_psms)
+    # Missing peptides aren't counted, like value_counts skips them
+    counted = (codes != -1) & all_psms.notna().values
 
-def create_peptide_list(left_file, right_file):
-    """Creates a list of all peptides as a DataFrame column"""
-    joined_left = csv_dataframe.join_dataframes(left_file)
-    joined_right = csv_dataframe.join_dataframes(right_file)
-    all_peptides = joined_left.append(joined_right, ignore_index=True) \
-        .drop_duplicates(subset=['Peptide'], keep='first').reset_index(drop=True)
-    return all_peptides
+    # Duplicate (peptide, sample) entries are summed when converting, which does the counting
+    matrix = sparse.coo_matrix((np.ones(counted.sum(), dtype=np.int32), (codes[counted], samples[counted])),
+                               shape=(len(vocabulary), len(columns))).tocsc()
+    return vocabulary, columns, sample_groups, matrix
 
 
-def create_counter_dataframe(files, group_name, directory, all_peptides):
-    """Creates full dataframe with peptide frequency in each sample"""
-    output_file = "output/{}/peptide_count/peptide_frequency_{}.csv".format(directory, group_name)
-    with open(files, "r") as file_list:
-        for num, file in enumerate(file_list):
-            file_data = csv_dataframe.extract_csv_data(file.strip(), drop_dupes=False)
-            counter_column = count_peptide_frequency(file_data, "{}{}".format(group_name, num + 1))
-            all_peptides = pd.merge(all_peptides, counter_column, on='Peptide', how='outer')
+def sparse_parts_per_million(matrix):
+    """Converts the counts of a sparse peptide x sample matrix to parts per million of each sample"""
+    sample_sums = np.asarray(matrix.sum(axis=0), dtype=np.float64).ravel()
+    scale = np.divide(1000000, sample_sums, out=np.zeros_like(sample_sums), where=sample_sums != 0)
+    return (matrix @ sparse.diags(scale)).tocsc()
+
+
+def dense_counts(vocabulary, columns, matrix):
+    """Converts the count matrix into a dataframe with a peptide column and a column per sample"""
+    counts = pd.DataFrame(matrix.toarray(), columns=columns)
+    counts.insert(0, 'Peptide', np.asarray(vocabulary, dtype=object))
+    return counts
+
+
+def count_matrix_file(directory):
+    return "output/{}/peptide_count/peptide_frequency.npz".format(directory)
+
+
+def write_count_matrix(vocabulary, columns, sample_groups, matrix, output_file):
+    """Stores the count matrix in an uncompressed .npz file, with the peptides packed into one byte buffer"""
+    peptides, offsets, missing = table_cache.pack_text(pd.Series(vocabulary, dtype=object))
+    with open(output_file, "wb") as output:
+        np.savez(output, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                 shape=np.array(matrix.shape), peptides=peptides, offsets=offsets, missing=missing,
+                 columns=np.array(columns, dtype=str), groups=np.array(sample_groups, dtype=str))
+
+
+def read_count_matrix(input_file):
+    """Reads a count matrix written by write_count_matrix, returns it like build_count_matrix"""
+    with np.load(input_file, allow_pickle=False) as data:
+        matrix = sparse.csc_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+        vocabulary = pd.Index(table_cache.unpack_text(data['peptides'], data['offsets'], data['missing']),
+                              dtype=object)
+        return vocabulary, data['columns'].tolist(), data['groups'].tolist(), matrix
+
 
-    all_peptides = all_peptides.fillna(0, downcast='infer')
+def create_count_matrix(groups, directory, ppm=False, dense_csv=False):
+    """Counts the peptides of all groups, writes the count matrix and with dense_csv a CSV file per group with the
+    frequency of every peptide in each sample of the group"""
+    vocabulary, columns, sample_groups, matrix = build_count_matrix(groups)
+    if ppm:
+        matrix = sparse_parts_per_million(matrix)
+    write_count_matrix(vocabulary, columns, sample_groups, matrix, count_matrix_file(directory))
 
-    # # Normalising to ppm
-    # for column in all_peptides.columns[1:]:
-    #     all_peptides[column] = parts_per_million(all_peptides[column])
+    if dense_csv:
+        for group_name, _ in groups:
+            group_samples = [num for num, sample_group in enumerate(sample_groups) if sample_group == group_name]
+            group_counts = dense_counts(vocabulary, [columns[num] for num in group_samples], matrix[:, group_samples])
+            output_file = "output/{}/peptide_count/peptide_frequency_{}.csv".format(directory, group_name)
+            with open(output_file, "w+") as output:
+                group_counts.to_csv(output, sep=',', mode='w', line_terminator='\n', index=False)
+    return vocabulary, columns, sample_groups, matrix
 
+
+def create_counter_dataframe(files, group_name, directory, all_peptides):
+    """Creates full dataframe with peptide frequency in each sample"""
+    output_file = "output/{}/peptide_count/peptide_frequency_{}.csv".format(directory, group_name)
+    vocabulary, columns, _, matrix = build_count_matrix([(group_name, files)], all_peptides.peptides())
+    all_peptides = dense_counts(vocabulary, columns, matrix)
     with open(output_file, "w+") as output_file:
         all_peptides.to_csv(output_file, sep=',', mode='w', line_terminator='\n', index=False)
     return all_peptides
 
 
-def mann_whitney_u_test(left_data, right_data, directory):
-    peptides = left_data[['Peptide']].copy()
-    for i, row in left_data.iterrows():
-        left = left_data.iloc[i, 1:].tolist()
-        right = right_data.iloc[i, 1:].tolist()
-        if all(sample == left[0] for sample in left + right):
-            continue
-        u_statistic, p_value = stats.mannwhitneyu(left, right, alternative='two-sided')
-        peptides.at[i, 'p-value'] = p_value
-        peptides.at[i, 'u-statistic'] = u_statistic
+def rank_rows(values):
+    """Ranks the values of every row, tied values get their average rank. Returns the ranks and per row the sum of
+    t^3 - t over every group of t tied values"""
+    rows, columns = values.shape
+    order = np.argsort(values, axis=1, kind='mergesort')
+    sorted_values = np.take_along_axis(values, order, axis=1)
+    run_starts = np.ones(values.shape, dtype=bool)
+    run_starts[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    # Every row starts a new run of tied values, so the runs can be numbered across the whole matrix
+    runs = np.cumsum(run_starts.ravel()) - 1
+    run_sizes = np.bincount(runs)
+    run_ranks = np.bincount(runs, weights=np.tile(np.arange(1, columns + 1, dtype=np.float64), rows)) / run_sizes
+    ranks = np.empty(values.shape, dtype=np.float64)
+    np.put_along_axis(ranks, order, run_ranks[runs].reshape(values.shape), axis=1)
+    run_rows = np.repeat(np.arange(rows), run_starts.sum(axis=1))
+    ties = np.bincount(run_rows, weights=run_sizes.astype(np.float64) ** 3 - run_sizes, minlength=rows)
+    return ranks, ties
+
+
+def mann_whitney_rows(left, right):
+    """Two-sided Mann-Whitney U test of every row of left against the same row of right, using the normal
+    approximation with tie and continuity correction. Returns the u-statistics of left and the p-values, both NaN
+    for rows where all values are equal"""
+    left_size = left.shape[1]
+    right_size = right.shape[1]
+    size = left_size + right_size
+    ranks, ties = rank_rows(np.hstack([left, right]).astype(np.float64))
+    u_statistic = ranks[:, :left_size].sum(axis=1) - left_size * (left_size + 1) / 2
+    big_u = np.maximum(u_statistic, left_size * right_size - u_statistic)
+    tie_correction = 1 - ties / (size ** 3 - size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (big_u - left_size * right_size / 2 - 0.5) / np.sqrt(tie_correction * left_size * right_size *
+                                                                  (size + 1) / 12)
+    p_value = np.minimum(2 * stats.norm.sf(z), 1)
+    constant = tie_correction == 0
+    u_statistic[constant] = np.nan
+    p_value[constant] = np.nan
+    return u_statistic, p_value
+
+
+def test_chunk(chunk):
+    """Runs mann_whitney_rows on a chunk of the count matrix, sparse chunks are made dense in the worker"""
+    left, right = chunk
+    if sparse.issparse(left):
+        left, right = left.toarray(), right.toarray()
+    return mann_whitney_rows(left, right)
+
+
+def mann_whitney_matrix(matrix, left_samples, right_samples, cpu=None, chunk_size=TEST_CHUNK_SIZE):
+    """Tests every peptide of a sparse or dense peptide x sample matrix, comparing the left samples with the right
+    samples. The peptides are split in chunks that are tested across a process pool"""
+    matrix = matrix.tocsr() if sparse.issparse(matrix) else np.asarray(matrix)
+    left_samples = list(left_samples)
+    right_samples = list(right_samples)
+    chunks = [(matrix[start:start + chunk_size][:, left_samples], matrix[start:start + chunk_size][:, right_samples])
+              for start in range(0, matrix.shape[0], chunk_size)]
+    if not chunks:
+        return np.array([]), np.array([])
+    if len(chunks) == 1 or cpu == 1:
+        results = [test_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=cpu) as executor:
+            results = list(executor.map(test_chunk, chunks))
+    return np.concatenate([u for u, _ in results]), np.concatenate([p for _, p in results])
+
+
+def write_mann_whitney(peptides, directory):
     peptides = peptides.sort_values(by=['p-value'], ascending=True)
     with open("output/{}_mann_peptides.csv".format(directory), "w+") as output:
         peptides.to_csv(output, sep=',', mode='w', line_terminator='\n')
     return peptides
 
 
-def multiple_test_correction(peptide_data, directory):
-    p_values = peptide_data['p-value'].tolist()
-    fdr_correction = sm.multipletests(p_values, alpha=0.05, method='fdr_bh', is_sorted=True)
-    peptide_data['p_adjusted'] = fdr_correction[1]
-    with open("output/{}_benj_peptides.csv".format(directory), "w+") as output:
+def mann_whitney_u_test(left_data, right_data, directory, cpu=None):
+    """Tests every peptide of two count dataframes with a peptide column and a column per sample"""
+    peptides = left_data[['Peptide']].copy()
+    left = left_data.iloc[:, 1:].values
+    right = right_data.iloc[:, 1:].values
+    u_statistics, p_values = mann_whitney_matrix(np.hstack([left, right]), range(left.shape[1]),
+                                                 range(left.shape[1], left.shape[1] + right.shape[1]), cpu)
+    peptides['p-value'] = p_values
+    peptides['u-statistic'] = u_statistics
+    return write_mann_whitney(peptides, directory)
+
+
+def mann_whitney_counts(vocabulary, sample_groups, matrix, left_name, right_name, directory, cpu=None):
+    """Tests every peptide of the count matrix, comparing the samples of the left group with the right group"""
+    u_statistics, p_values = mann_whitney_matrix(
+        matrix, [num for num, group in enumerate(sample_groups) if group == left_name],
+        [num for num, group in enumerate(sample_groups) if group == right_name], cpu)
+    peptides = pd.DataFrame({'Peptide': np.asarray(vocabulary, dtype=object), 'p-value': p_values,
+                             'u-statistic': u_statistics}, columns=['Peptide', 'p-value', 'u-statistic'])
+    return write_mann_whitney(peptides, directory)
+
+
+def mean_differences(matrix, left_indicator, left_size, right_size):
+    """Returns the absolute difference in mean between the left and right samples of every row, for every column of
+    left_indicator (a samples x permutations matrix marking the left samples with 1)"""
+    left_sums = np.asarray(matrix @ left_indicator)
+    right_sums = np.asarray(matrix.sum(axis=1)).reshape(-1, 1) - left_sums
+    return np.abs(left_sums / left_size - right_sums / right_size)
+
+
+def permutation_indicator(seed, sample_count, left_size, batch_size):
+    """Draws a batch of label permutations as index arrays and returns the samples x permutations left indicator"""
+    permutations = np.argsort(np.random.default_rng(seed).random((batch_size, sample_count)), axis=1)
+    indicator = np.zeros((sample_count, batch_size))
+    indicator[permutations[:, :left_size], np.arange(batch_size).reshape(-1, 1)] = 1
+    return indicator
+
+
+def init_permutation_worker(matrix, left_size):
+    permutation_state["matrix"] = matrix
+    permutation_state["left_size"] = left_size
+
+
+def permute_batch(batch):
+    """Counts per row how many permutations of the batch give a difference at least as large as the observed one"""
+    rows, observed, seed, batch_size = batch
+    matrix = permutation_state["matrix"][rows]
+    left_size = permutation_state["left_size"]
+    indicator = permutation_indicator(seed, matrix.shape[1], left_size, batch_size)
+    differences = mean_differences(matrix, indicator, left_size, matrix.shape[1] - left_size)
+    # The tolerance keeps permutations giving the observed difference from being lost to rounding
+    return (differences >= observed.reshape(-1, 1) - 1e-9 * np.maximum(observed, 1).reshape(-1, 1)).sum(axis=1)
+
+
+def permutation_test(matrix, left_samples, right_samples, permutations=10000, seed=None, cpu=None,
+                     batch_size=PERMUTATION_BATCH_SIZE, stop_hits=PERMUTATION_STOP_HITS, cells=PERMUTATION_CELLS):
+    """Permutation test of the difference in mean between the left and right samples of every peptide of a sparse or
+    dense peptide x sample matrix. Permutations are drawn in batches, every batch from its own child of the seed, and
+    the batches are spread over a process pool in chunks of at most <cells> peptides x permutations. Peptides are no
+    longer permuted once stop_hits permutations were as extreme as the observed difference, so the results only
+    depend on the seed and not on the number of CPUs.
+    Returns the observed differences, the empirical p-values and the number of permutations of every peptide,
+    peptides with equal values in all samples get no p-value"""
+    if not len(left_samples) or not len(right_samples):
+        raise ValueError("The permutation test needs samples in both groups, got {} left and {} right samples"
+                         .format(len(left_samples), len(right_samples)))
+    samples = list(left_samples) + list(right_samples)
+    left_size = len(left_samples)
+    matrix = sparse.csr_matrix(matrix)[:, samples].astype(np.float64)
+    rows = matrix.shape[0]
+    labels = (np.arange(len(samples)) < left_size).astype(np.float64).reshape(-1, 1)
+    observed = mean_differences(matrix, labels, left_size, len(samples) - left_size).ravel()
+
+    hits = np.zeros(rows, dtype=np.int64)
+    done = np.zeros(rows, dtype=np.int64)
+    constant = (matrix.max(axis=1).toarray().ravel() == matrix.min(axis=1).toarray().ravel())
+    active = np.flatnonzero(~constant)
+    batch_sizes = [min(batch_size, permutations - start) for start in range(0, permutations, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    chunk_rows = max(1, cells // batch_size)
+    cpu = cpu if cpu is not None else os.cpu_count()
+
+    with ProcessPoolExecutor(max_workers=cpu, initializer=init_permutation_worker,
+                             initargs=(matrix, left_size)) as executor:
+        for first in range(0, len(batch_sizes), cpu):
+            if len(active) == 0:
+                break
+            numbers = range(first, min(first + cpu, len(batch_sizes)))
+            # Every chunk of a batch draws the same permutations from the seed of the batch
+            chunks = [active[start:start + chunk_rows] for start in range(0, len(active), chunk_rows)]
+            results = executor.map(permute_batch, [(rows, observed[rows], seeds[number], batch_sizes[number])
+                                                   for number in numbers for rows in chunks])
+            # Batches are merged in order, a peptide that reached stop_hits ignores the batches after it
+            still_active = np.ones(len(active), dtype=bool)
+            for number in numbers:
+                batch_hits = np.concatenate([next(results) for _ in chunks])
+                hits[active[still_active]] += batch_hits[still_active]
+                done[active[still_active]] += batch_sizes[number]
+                still_active &= hits[active] < stop_hits
+            active = active[still_active]
+
+    p_values = (hits + 1) / (done + 1)
+    p_values[constant] = np.nan
+    return observed, p_values, done
+
+
+def permutation_counts(vocabulary, sample_groups, matrix, left_name, right_name, directory, permutations=10000,
+                       seed=None, cpu=None):
+    """Permutation tests every peptide of the count matrix and writes the results sorted by p-value"""
+    differences, p_values, done = permutation_test(
+        matrix, [num for num, group in enumerate(sample_groups) if group == left_name],
+        [num for num, group in enumerate(sample_groups) if group == right_name], permutations, seed, cpu)
+    peptides = pd.DataFrame({'Peptide': np.asarray(vocabulary, dtype=object), 'p-value': p_values,
+                             'difference': differences, 'permutations': done},
+                            columns=['Peptide', 'p-value', 'difference', 'permutations'])
+    peptides = peptides.sort_values(by=['p-value'], ascending=True)
+    with open("output/{}_permutation_peptides.csv".format(directory), "w+") as output:
+        peptides.to_csv(output, sep=',', mode='w', line_terminator='\n')
+    return peptides
+
+
+def multiple_test_correction(peptide_data, directory, name="benj"):
+    """Adds the Benjamini-Hochberg adjusted p-values, peptides without a p-value keep it missing"""
+    tested = peptide_data['p-value'].notna().values
+    peptide_data['p_adjusted'] = np.nan
+    if tested.any():
+        fdr_correction = sm.multipletests(peptide_data['p-value'].values[tested], alpha=0.05, method='fdr_bh')
+        peptide_data.loc[tested, 'p_adjusted'] = fdr_correction[1]
+    with open("output/{}_{}_peptides.csv".format(directory, name), "w+") as output:
         peptide_data.to_csv(output, sep=',', mode='w', line_terminator='\n')
 
 
@@ -99,6 +353,26 @@ def main(argv):
                         help="Name the right sample")
     parser.add_argument('-o', '--outdir', action='store', dest='outdir', default="peptides",
                         help="Provide an output directory name, i.e. 'output/<NAME>/peptide_count/'")
+    parser.add_argument('--ppm', action='store_true', dest="ppm",
+                        help="Normalise the counts to parts per million of each sample")
+    parser.add_argument('--dense-csv', action='store_true', dest="dense_csv",
+                        help="Also write a CSV file per group with the frequency of every peptide in each sample")
+    parser.add_argument('--mann-whitney', action='store_true', dest="mann_whitney",
+                        help="Test every peptide for a difference between the groups with a Mann-Whitney U test and "
+                             "correct the p-values for multiple testing")
+    parser.add_argument('--permutations', action='store', dest="permutations", type=int,
+                        help="Test every peptide for a difference in mean frequency between the groups with this many "
+                             "label permutations and correct the p-values for multiple testing")
+    parser.add_argument('--seed', action='store', dest="seed", type=int,
+                        help="Provide a seed for the permutations, to reproduce an earlier run")
+    parser.add_argument('--cpu', action='store', dest="cpu", type=int,
+                        help="Provide number of CPUs for the statistical tests")
+    parser.add_argument('--no-cache', action='store_false', dest="cache",
+                        help="Bypass the cache of cleaned peptide tables")
+    parser.add_argument('--clear-cache', action='store_true', dest="clear_cache",
+                        help="Remove all cached peptide tables before running")
+    parser.add_argument('--cache-size', action='store', dest="cache_size", type=int,
+                        help="Provide the maximum size of the peptide table cache in MB")
     args = parser.parse_args()
 
     try:
@@ -112,9 +386,23 @@ def main(argv):
 
     try:
         print("Started at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
-        peptides = create_peptide_list(args.left, args.right)
-        create_counter_dataframe(args.left, args.left_name, args.outdir, peptides)
-        create_counter_dataframe(args.right, args.right_name, args.outdir, peptides)
+        table_cache.configure(enabled=args.cache,
+                              max_size=None if args.cache_size is None else args.cache_size * 1024 ** 2)
+        if args.clear_cache:
+            table_cache.clear()
+        vocabulary, _, sample_groups, matrix = create_count_matrix(
+            [(args.left_name, args.left), (args.right_name, args.right)], args.outdir, ppm=args.ppm,
+            dense_csv=args.dense_csv)
+        if args.mann_whitney:
+            tested = mann_whitney_counts(vocabulary, sample_groups, matrix, args.left_name, args.right_name,
+                                         args.outdir, args.cpu)
+            multiple_test_correction(tested, args.outdir)
+        if args.permutations:
+            seed = args.seed if args.seed is not None else np.random.SeedSequence().entropy
+            print("Permutation seed: {}".format(seed))
+            tested = permutation_counts(vocabulary, sample_groups, matrix, args.left_name, args.right_name,
+                                        args.outdir, args.permutations, seed, args.cpu)
+            multiple_test_correction(tested, args.outdir, name="permutation_benj")
 
         print("Finished at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
     except FileNotFoundError as e:
@@ -122,6 +410,9 @@ def main(argv):
         print("Please provide valid files:")
         print(e)
         sys.exit(2)
+    except ValueError as e:
+        print(e)
+        sys.exit(2)
 
 
 if __name__ == '__main__':
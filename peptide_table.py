@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+"""
+A compact peptide store shared by the modules. Every distinct peptide sequence is interned once into a packed byte
+buffer with an offsets array, the rows of a table are integer IDs into those sequences. Lookups, set operations and
+de-duplication work on the IDs and on sorted 64-bit hashes of the sequences, every hash hit is verified on the bytes,
+so no Python string is created until the peptides are written out.
+"""
+import numpy as np
+import pandas as pd
+
+# Seed of the random multipliers of the sequence hash, every table has to hash with the same multipliers
+HASH_SEED = 0x5EED
+LENGTH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def pack_sequences(sequences):
+    """Packs byte strings into one byte buffer and an offsets array"""
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum([len(sequence) for sequence in sequences], out=offsets[1:])
+    return np.frombuffer(b"".join(sequences), dtype=np.uint8), offsets
+
+
+def encode_peptides(peptides):
+    """Packs the peptide strings that aren't missing, returns them with the mask of missing peptides like
+    table_cache.pack_text"""
+    missing = np.array([not isinstance(peptide, str) and pd.isna(peptide) for peptide in peptides], dtype=bool)
+    buffer, offsets = pack_sequences([str(peptide).encode("ascii", "replace")
+                                      for peptide, is_missing in zip(peptides, missing) if not is_missing])
+    return buffer, offsets, missing
+
+
+def gather(buffer, starts, lengths):
+    """Returns the bytes of the sequences at the start offsets one after another, the position of every byte within
+    its sequence and the offsets of the sequences"""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    positions = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+    if len(starts) and np.array_equal(starts[1:], starts[:-1] + lengths[:-1]):
+        # Packed sequences are already one after another
+        return buffer[starts[0]:starts[0] + offsets[-1]], positions, offsets
+    return buffer[np.repeat(starts, lengths) + positions], positions, offsets
+
+
+def segment_sums(values, offsets):
+    """Sums the values of every sequence, wrapping around for unsigned integers"""
+    sums = np.zeros(len(values) + 1, dtype=values.dtype)
+    np.cumsum(values, out=sums[1:])
+    return sums[offsets[1:]] - sums[offsets[:-1]]
+
+
+def sequence_hashes(buffer, starts, lengths):
+    """Hashes the sequences at the start offsets to 64 bits: the sum of every residue times a random multiplier of
+    its position, plus the length. All sequences are hashed at once, without a loop over the residues"""
+    values, positions, offsets = gather(buffer, starts, lengths)
+    multipliers = np.random.RandomState(HASH_SEED).randint(0, 2 ** 63, size=int(lengths.max(initial=0)),
+                                                            dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    with np.errstate(over='ignore'):
+        hashes = segment_sums(values.astype(np.uint64) * multipliers[positions], offsets)
+        return hashes + lengths.astype(np.uint64) * LENGTH_MULTIPLIER
+
+
+def same_sequences(buffer, starts, lengths, other_buffer, other_starts, other_lengths):
+    """Compares the sequences at the start offsets pairwise"""
+    same = lengths == other_lengths
+    values, _, offsets = gather(buffer, starts[same], lengths[same])
+    other_values, _, _ = gather(other_buffer, other_starts[same], lengths[same])
+    same[same] = segment_sums((values != other_values).astype(np.int64), offsets) == 0
+    return same
+
+
+def fixed_width(buffer, starts, lengths):
+    """Returns the sequences as a NumPy bytes array of one width, padded with zero bytes"""
+    width = max(int(lengths.max()) if len(lengths) else 0, 1)
+    columns = np.arange(width)
+    inside = columns < lengths[:, None]
+    padded = np.zeros((len(lengths), width), dtype=np.uint8)
+    padded[inside] = buffer[(starts[:, None] + columns)[inside]]
+    return padded.view("S{}".format(width)).ravel()
+
+
+def intern(buffer, starts, lengths):
+    """Interns the sequences at the start offsets of the buffer, numbered in order of first appearance. Returns the
+    packed distinct sequences, the ID of every sequence and the hashes of the distinct sequences"""
+    hashes = sequence_hashes(buffer, starts, lengths)
+    _, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    if not same_sequences(buffer, starts, lengths, buffer, starts[first[inverse]], lengths[first[inverse]]).all():
+        # Two different sequences share a hash, fall back on sorting the sequences themselves
+        _, first, inverse = np.unique(fixed_width(buffer, starts, lengths), return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+    order = np.argsort(first, kind="stable")
+    renumber = np.empty(len(order), dtype=np.int64)
+    renumber[order] = np.arange(len(order))
+    sequences, _, offsets = gather(buffer, starts[first[order]], lengths[first[order]])
+    return (sequences, offsets), renumber[inverse], hashes[first[order]]
+
+
+class PeptideTable:
+    """Rows of peptides stored as IDs into interned sequences. The sequences are unique, the rows keep their order
+    and row labels (index) like a DataFrame, so filtered tables can be written with their original row numbers"""
+
+    def __init__(self, buffer, offsets, ids, index=None, hashes=None):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.index = np.arange(len(self.ids), dtype=np.int64) if index is None else np.asarray(index, dtype=np.int64)
+        self._hashes = hashes
+        self._order = None
+
+    @classmethod
+    def from_peptides(cls, peptides, index=None):
+        """Interns the peptide strings. Missing peptides are left out, so they are never searched or counted, the
+        other rows keep their row labels"""
+        buffer, offsets, missing = encode_peptides(peptides)
+        index = np.arange(len(missing), dtype=np.int64) if index is None else np.asarray(index, dtype=np.int64)
+        (buffer, offsets), ids, hashes = intern(buffer, offsets[:-1], np.diff(offsets))
+        return cls(buffer, offsets, ids, index[~missing], hashes)
+
+    @classmethod
+    def from_frame(cls, data):
+        """Interns the Peptide column of a DataFrame, keeping its row labels"""
+        return cls.from_peptides(data['Peptide'].tolist(), data.index)
+
+    @classmethod
+    def concat(cls, tables):
+        """Concatenates the rows of the tables into a table with one set of interned sequences, the row labels are
+        renumbered like pandas.concat with ignore_index"""
+        tables = list(tables)
+        if not tables:
+            return cls.from_peptides([])
+        shifts = np.cumsum([0] + [len(table.buffer) for table in tables[:-1]])
+        buffer = np.concatenate([table.buffer for table in tables])
+        starts = np.concatenate([table.starts() + shift for table, shift in zip(tables, shifts)])
+        lengths = np.concatenate([table.lengths() for table in tables])
+        (buffer, offsets), ids, hashes = intern(buffer, starts, lengths)
+        return cls(buffer, offsets, ids, hashes=hashes)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, rows):
+        """Selects rows by a boolean mask or positions, the sequences are shared with the selection"""
+        table = PeptideTable(self.buffer, self.offsets, self.ids[rows], self.index[rows], self._hashes)
+        table._order = self._order
+        return table
+
+    def sequence_count(self):
+        return len(self.offsets) - 1
+
+    def sequence(self, peptide_id):
+        return self.buffer[self.offsets[peptide_id]:self.offsets[peptide_id + 1]].tobytes()
+
+    def starts(self):
+        """Returns the offset of the sequence of every row in the buffer"""
+        return self.offsets[self.ids]
+
+    def lengths(self):
+        return self.offsets[self.ids + 1] - self.offsets[self.ids]
+
+    def peptides(self):
+        """Returns the peptide string of every row"""
+        sequences = self.buffer.tobytes()
+        starts = self.starts().tolist()
+        ends = self.offsets[self.ids + 1].tolist()
+        return [sequences[start:end].decode("ascii") for start, end in zip(starts, ends)]
+
+    def hashes(self):
+        """Returns the hash of every interned sequence, indexed by ID"""
+        if self._hashes is None:
+            self._hashes = sequence_hashes(self.buffer, self.offsets[:-1], np.diff(self.offsets))
+        if self._order is None:
+            self._order = np.argsort(self._hashes, kind="stable")
+        return self._hashes
+
+    def lookup(self, peptides):
+        """Returns the ID of every peptide (a list of strings or a PeptideTable), -1 for peptides not in the table
+        and missing peptides"""
+        if not isinstance(peptides, PeptideTable):
+            # The row labels of the table are the positions of the peptides that aren't missing
+            table = PeptideTable.from_peptides(peptides)
+            ids = np.full(len(peptides), -1, dtype=np.int64)
+            ids[table.index] = self.lookup(table)
+            return ids
+        queries = peptides.hashes()[peptides.ids]
+        hashes = self.hashes()
+        if len(hashes) == 0:
+            return np.full(len(queries), -1, dtype=np.int64)
+        sorted_hashes = hashes[self._order]
+        # Searching the queries in sorted order keeps the binary searches cache friendly
+        query_order = np.argsort(queries)
+        positions = np.empty(len(queries), dtype=np.int64)
+        positions[query_order] = np.searchsorted(sorted_hashes, queries[query_order])
+        positions = np.minimum(positions, len(hashes) - 1)
+        ids = np.where(sorted_hashes[positions] == queries, self._order[positions], -1)
+
+        hits = np.flatnonzero(ids >= 0)
+        offsets = self.offsets
+        same = same_sequences(self.buffer, offsets[ids[hits]], offsets[ids[hits] + 1] - offsets[ids[hits]],
+                              peptides.buffer, peptides.starts()[hits], peptides.lengths()[hits])
+        for hit in hits[~same]:
+            # A hash shared by different sequences, try the other sequences with that hash
+            ids[hit] = -1
+            for position in range(positions[hit] + 1, len(hashes)):
+                candidate = self._order[position]
+                if sorted_hashes[position] != queries[hit]:
+                    break
+                if self.sequence(candidate) == peptides.sequence(peptides.ids[hit]):
+                    ids[hit] = candidate
+                    break
+        return ids
+
+    def isin(self, other):
+        """Returns a boolean mask of the rows whose peptide occurs in the other table"""
+        present = np.zeros(self.sequence_count(), dtype=bool)
+        found = self.lookup(other)
+        present[found[found >= 0]] = True
+        return present[self.ids]
+
+    def unique(self):
+        """Keeps the first row of every peptide"""
+        _, first = np.unique(self.ids, return_index=True)
+        return self[np.sort(first)]
+
+    def intersection(self, other):
+        """Returns the rows of this table with a peptide that also occurs in the other table"""
+        return self[self.isin(other)]
+
+    def difference(self, other):
+        """Returns the rows of this table with a peptide that doesn't occur in the other table"""
+        return self[~self.isin(other)]
+
+    def union(self, other):
+        """Returns the unique peptides of this table followed by those only found in the other table"""
+        return PeptideTable.concat([self.unique(), other.difference(self).unique()])
+
+    def reset_index(self):
+        table = PeptideTable(self.buffer, self.offsets, self.ids, hashes=self._hashes)
+        table._order = self._order
+        return table
+
+    def to_frame(self):
+        """Returns the rows as a DataFrame with a Peptide column and the row labels as index"""
+        return pd.DataFrame({'Peptide': self.peptides()}, index=pd.Index(self.index), columns=['Peptide'])
@@ -8,57 +8,61 @@ import datetime
 import os
 import sys
 
-from matplotlib import pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from matplotlib_venn import venn2
 
 import csv_dataframe
 
 
+PATCH_COLOURS = {'10': '#33C4A4', '01': '#85ca00', '11': '#FFD54D'}
+
+
+def style_venn(venn):
+    """Sets the label size and patch colours of a venn diagram, empty subsets have no label or patch"""
+    for text in venn.subset_labels:
+        if text is not None:
+            text.set_fontsize(16)
+    for subset, colour in PATCH_COLOURS.items():
+        patch = venn.get_patch_by_id(subset)
+        if patch is not None:
+            patch.set_color(colour)
+            patch.set_edgecolor('none')
+            patch.set_alpha(0.8)
+
+
 def create_venn_diagrams(left, right, left_name, right_name, directory):
     """Creates venn diagrams from the unique peptide lists of each file"""
+    left = left.unique()
+    right = right.unique()
+    in_both = len(left.intersection(right))
+    subsets = (len(left) - in_both, len(right) - in_both, in_both)
 
-    set_left = set(left.Peptide)
-    set_right = set(right.Peptide)
-
-    fig, axes = plt.subplots(nrows=1, ncols=2)
-    v1 = venn2([set_left, set_right], set_labels=(left_name, right_name), ax=axes[0])
+    # Not using pyplot keeps the figure local, so several diagrams can be drawn from concurrent threads
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(nrows=1, ncols=2)
+    v1 = venn2(subsets, set_labels=(left_name, right_name), ax=axes[0])
 
     # In absolute numbers
-    for text in v1.subset_labels:
-        text.set_fontsize(16)
-    v1.get_patch_by_id('10').set_color('#33C4A4')
-    v1.get_patch_by_id('10').set_edgecolor('none')
-    v1.get_patch_by_id('10').set_alpha(0.8)
-    v1.get_patch_by_id('01').set_color('#85ca00')
-    v1.get_patch_by_id('01').set_edgecolor('none')
-    v1.get_patch_by_id('01').set_alpha(0.8)
-    v1.get_patch_by_id('11').set_color('#FFD54D')
-    v1.get_patch_by_id('11').set_edgecolor('none')
-    v1.get_patch_by_id('11').set_alpha(0.8)
-
-    total_v2 = len(set_left.union(set_right))
-    v2 = venn2([set_left, set_right], set_labels=(left_name, right_name), ax=axes[1],
-               subset_label_formatter=lambda x: f"{(x/total_v2):.1%}")
+    style_venn(v1)
+
+    # Two empty peptide lists have no percentages, their diagram is drawn without subset labels
+    total_v2 = sum(subsets)
+    v2 = venn2(subsets, set_labels=(left_name, right_name), ax=axes[1],
+               subset_label_formatter=lambda x: f"{(x/total_v2):.1%}" if total_v2 else "")
 
     # In percentages
-    for text in v2.subset_labels:
-        text.set_fontsize(16)
-    v2.get_patch_by_id('10').set_color('#33C4A4')
-    v2.get_patch_by_id('10').set_edgecolor('none')
-    v2.get_patch_by_id('10').set_alpha(0.8)
-    v2.get_patch_by_id('01').set_color('#85ca00')
-    v2.get_patch_by_id('01').set_edgecolor('none')
-    v2.get_patch_by_id('01').set_alpha(0.8)
-    v2.get_patch_by_id('11').set_color('#FFD54D')
-    v2.get_patch_by_id('11').set_edgecolor('none')
-    v2.get_patch_by_id('11').set_alpha(0.8)
-    v2.get_label_by_id('01').set_y(0.05)
-    v2.get_label_by_id('11').set_y(-0.05)
-
-    plt.suptitle('Comparing {} and {} peptide matches \nin {}'.format(left_name, right_name, directory))
-    plt.subplots_adjust(wspace=0.5, hspace=0.5)
-    plt.tight_layout()
-    plt.savefig('output/{}/comparison_graphs/venn_{}_{}.png'.format(directory, left_name, right_name), transparent=True)
+    style_venn(v2)
+    if v2.get_label_by_id('01') is not None:
+        v2.get_label_by_id('01').set_y(0.05)
+    if v2.get_label_by_id('11') is not None:
+        v2.get_label_by_id('11').set_y(-0.05)
+
+    fig.suptitle('Comparing {} and {} peptide matches \nin {}'.format(left_name, right_name, directory))
+    fig.subplots_adjust(wspace=0.5, hspace=0.5)
+    fig.tight_layout()
+    fig.savefig('output/{}/comparison_graphs/venn_{}_{}.png'.format(directory, left_name, right_name), transparent=True)
 
 
 def main(argv):
@@ -2,15 +2,19 @@
 """A simple pipeline to filter peptide lists and preps data  for future use"""
 import argparse
 import datetime
-import multiprocessing as mp
 import os
 import sys
+from functools import partial
 
 import csv_dataframe
 import peaks_peptide_comparison
 import peptide_frequency
 import peptide_venn
+import protein_index
+import stage_scheduler
+import table_cache
 import unknown_peptide_seeker
+from stage_scheduler import Stage
 
 
 def make_directories(dir_name):
@@ -40,51 +44,49 @@ def make_directories(dir_name):
         pass
 
 
-def compare_samples(left, right, name, left_name, right_name, prefix):
-    try:
-        print("*** Comparing {} and {} ***".format(left_name, right_name))
-        print("Started at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
+def compare_samples(left, right, left_name, right_name):
+    print("*** Comparing {} and {} ***".format(left_name, right_name))
+    print("Started at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
 
-        peaks_peptide_comparison.find_distinct_peptides(left, right, prefix, left_name, right_name, name)
-        print("Finished at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
-    except FileNotFoundError as e:
-        print(__doc__)
-        print("Please provide valid files:")
-        print(e)
-        sys.exit(2)
+    distinct_peptides = peaks_peptide_comparison.find_distinct_peptides(left, right)
+    print("Finished at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
+    return distinct_peptides
 
 
-def find_unknowns(dataframe, database, name, directory):
+def find_unknowns(dataframe, database, name, index=None, cpu=None, digest=None, folding=(), mapping_dir=None,
+                  max_hits=unknown_peptide_seeker.MAX_HITS, variants_dir=None):
     try:
         print("*** finding {} peptides not appearing in database***".format(name))
         print("Started at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
 
-        cpu = os.cpu_count()
-        pool = mp.Pool(processes=cpu)
-        results = pool.map(unknown_peptide_seeker.search_peptide_db,
-                           [(dataframe, database, cpu, i) for i in range(1, cpu + 1)])
-        pool.close()
-        pool.join()
-
-        merged_flags = unknown_peptide_seeker.merge_flags(results)
-        unknown_peptide_seeker.write_unknown_peptide_data(dataframe, merged_flags, name, directory)
+        if cpu is None:
+            cpu = os.cpu_count()
+        if mapping_dir is not None:
+            merged_flags, mapping = unknown_peptide_seeker.map_peptides(dataframe, database, cpu, index, folding,
+                                                                        max_hits)
+            unknown_peptide_seeker.write_peptide_mapping(mapping, name, mapping_dir)
+        else:
+            merged_flags = unknown_peptide_seeker.search_peptides(dataframe, database, cpu, index, digest, folding)
+        if variants_dir is not None:
+            variant_data = unknown_peptide_seeker.classify_peptides(dataframe, merged_flags, database, cpu, folding)
+            unknown_peptide_seeker.write_variant_peptides(variant_data, name, variants_dir)
         print("Finished at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
+        return unknown_peptide_seeker.filter_unknown_peptides(dataframe, merged_flags)
     except FileNotFoundError as e:
         print(__doc__)
         print("Please provide valid files:")
         print(e)
         sys.exit(2)
+    except protein_index.StaleIndexError as e:
+        print(e)
+        sys.exit(1)
 
 
-def compare_distinct_unknown(directory, data_name):
-    left = "output/{}/comparison_output/all_distinct_{}.csv".format(directory, data_name)
-    left_data = csv_dataframe.extract_csv_data(left, drop_dupes=True)
-    right = "output/{}/unknown_peptides/{}_unknown.csv".format(directory, data_name)
-    right_data = csv_dataframe.extract_csv_data(right, drop_dupes=True)
-    prefix = data_name
+def compare_distinct_unknown(all_distinct, unknown_data, side):
+    """Compares the peptides only found on one side (0 is left, 1 is right) with its unknown peptides"""
     left_name = "distinct"
     right_name = "unknown"
-    compare_samples(left_data, right_data, directory, left_name, right_name, prefix)
+    return compare_samples(all_distinct[side], unknown_data, left_name, right_name)
 
 
 def create_graph(left, right, left_name, right_name, directory):
@@ -101,23 +103,20 @@ def create_graph(left, right, left_name, right_name, directory):
         sys.exit(2)
 
 
-def create_sub_graph(directory, data_name):
-    left = "output/{}/comparison_output/all_distinct_{}.csv".format(directory, data_name)
-    left_data = csv_dataframe.extract_csv_data(left, drop_dupes=True)
-    right = "output/{}/comparison_output/{}_distinct_distinct.csv".format(directory, data_name)
-    right_data = csv_dataframe.extract_csv_data(right, drop_dupes=True)
+def create_sub_graph(all_distinct, distinct_unknown, side, directory, data_name):
+    left_data = all_distinct[side]
+    right_data = distinct_unknown[0]
     left_name = "distinct {}".format(data_name)
     right_name = "distinct database {}".format(data_name)
     create_graph(left_data, right_data, left_name, right_name, directory)
 
 
-def count_peptides(left, right, left_name, right_name, directory):
+def count_peptides(left, right, left_name, right_name, directory, ppm=False, dense_csv=False):
     try:
         print("*** Counting peptides***")
         print("Started at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
-        peptides = peptide_frequency.create_peptide_list(left, right)
-        peptide_frequency.create_counter_dataframe(left, left_name, directory, peptides)
-        peptide_frequency.create_counter_dataframe(right, right_name, directory, peptides)
+        peptide_frequency.create_count_matrix([(left_name, left), (right_name, right)], directory, ppm=ppm,
+                                              dense_csv=dense_csv)
 
         print("Finished at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
     except FileNotFoundError as e:
@@ -127,6 +126,112 @@ def count_peptides(left, right, left_name, right_name, directory):
         sys.exit(2)
 
 
+def list_sources(data):
+    """Returns the .txt file and the CSV files it lists, so a change to either invalidates the stages using them"""
+    try:
+        return [data] + csv_dataframe.list_csv_files(data) if data.endswith(".txt") else [data]
+    except FileNotFoundError:
+        return [data]
+
+
+def load_workers(data, cpu_budget):
+    """Returns the number of processes loading the CSV files of a group, one per file within the CPU budget"""
+    try:
+        return max(1, min(cpu_budget, len(csv_dataframe.list_csv_files(data))))
+    except FileNotFoundError:
+        return 1
+
+
+def build_stages(args, cpu_budget):
+    """Declares the pipeline stages with the artifacts they need and produce and the files they read and write"""
+    graphs = "output/{}/comparison_graphs/".format(args.name)
+    database_sources = [args.database]
+    if args.index is not None:
+        database_sources.append(os.path.join(args.index, "meta.json"))
+    if args.digest is not None:
+        database_sources.append(os.path.join(args.digest, "digest.json"))
+    # The two database searches get half of the CPUs each, so they can run side by side. A search in the index is
+    # a single loop, only the variant search still needs a pool then
+    search_cpus = max(1, cpu_budget // 2)
+    unknown_cpus = 1 if args.index is not None and not args.variants else search_cpus
+
+    count_files = [peptide_frequency.count_matrix_file(args.name)]
+    if args.dense_csv:
+        count_files += ["output/{}/peptide_count/peptide_frequency_{}.csv".format(args.name, group_name)
+                        for group_name in (args.left_name, args.right_name)]
+
+    stages = [
+        Stage(name="count_peptides",
+              function=partial(count_peptides, args.left, args.right, args.left_name, args.right_name, args.name,
+                               ppm=args.ppm, dense_csv=args.dense_csv),
+              inputs=[], outputs=[], cpus=1,
+              params=[args.left_name, args.right_name, args.ppm, args.dense_csv],
+              sources=list_sources(args.left) + list_sources(args.right),
+              targets=count_files),
+        Stage(name="compare_all",
+              function=partial(compare_samples, left_name=args.left_name, right_name=args.right_name),
+              inputs=["left_data", "right_data"], outputs=["all_distinct"], cpus=1,
+              params=[args.left_name, args.right_name],
+              targets=peaks_peptide_comparison.distinct_peptide_files("all", args.left_name, args.right_name,
+                                                                      args.name),
+              write=partial(peaks_peptide_comparison.write_distinct_peptides, prefix="all",
+                            left_name=args.left_name, right_name=args.right_name, output_dir=args.name),
+              load=partial(peaks_peptide_comparison.read_distinct_peptides, "all", args.left_name,
+                           args.right_name, args.name)),
+        Stage(name="venn_all",
+              function=partial(create_graph, left_name=args.left_name, right_name=args.right_name,
+                               directory=args.name),
+              inputs=["left_data", "right_data"], outputs=[], cpus=1,
+              params=[args.left_name, args.right_name],
+              targets=[graphs + "venn_{}_{}.png".format(args.left_name, args.right_name)]),
+    ]
+    for side, (key, data, data_name) in enumerate((("left", args.left, args.left_name),
+                                                   ("right", args.right, args.right_name))):
+        unknown_file = "output/{}/unknown_peptides/{}_unknown.csv".format(args.name, data_name)
+        unknown_files = [unknown_file]
+        if args.mapping:
+            unknown_files.append(unknown_peptide_seeker.mapping_file(data_name, args.name))
+        if args.variants:
+            unknown_files.append(unknown_peptide_seeker.variant_file(data_name, args.name))
+        load_cpus = load_workers(data, cpu_budget)
+        stages += [
+            Stage(name="load_" + key,
+                  function=partial(csv_dataframe.join_dataframes, data, workers=load_cpus),
+                  inputs=[], outputs=[key + "_data"], cpus=load_cpus,
+                  sources=list_sources(data)),
+            Stage(name="unknowns_" + key,
+                  function=partial(find_unknowns, database=args.database, name=data_name, index=args.index,
+                                   cpu=unknown_cpus, digest=args.digest, folding=args.folding,
+                                   mapping_dir=args.name if args.mapping else None, max_hits=args.max_hits,
+                                   variants_dir=args.name if args.variants else None),
+                  inputs=[key + "_data"], outputs=[key + "_unknown"], cpus=unknown_cpus,
+                  params=[data_name, args.index, args.digest, args.folding, args.mapping, args.max_hits,
+                          args.variants],
+                  sources=database_sources,
+                  targets=unknown_files,
+                  write=partial(unknown_peptide_seeker.write_unknown_peptides, prefix=data_name,
+                                directory=args.name),
+                  load=partial(csv_dataframe.load_peptide_table, unknown_file)),
+            Stage(name="distinct_unknown_" + key,
+                  function=partial(compare_distinct_unknown, side=side),
+                  inputs=["all_distinct", key + "_unknown"], outputs=[key + "_distinct_unknown"],
+                  cpus=1,
+                  params=[data_name],
+                  targets=peaks_peptide_comparison.distinct_peptide_files(data_name, "distinct", "unknown",
+                                                                          args.name),
+                  write=partial(peaks_peptide_comparison.write_distinct_peptides, prefix=data_name,
+                                left_name="distinct", right_name="unknown", output_dir=args.name),
+                  load=partial(peaks_peptide_comparison.read_distinct_peptides, data_name, "distinct", "unknown",
+                               args.name)),
+            Stage(name="venn_" + key,
+                  function=partial(create_sub_graph, side=side, directory=args.name, data_name=data_name),
+                  inputs=["all_distinct", key + "_distinct_unknown"], outputs=[], cpus=1,
+                  params=[data_name],
+                  targets=[graphs + "venn_distinct {}_distinct database {}.png".format(data_name, data_name)]),
+        ]
+    return stages
+
+
 def main(argv):
     print(' '.join(argv))
     parser = argparse.ArgumentParser(description=__doc__)
@@ -138,33 +243,63 @@ def main(argv):
                              "containing paths to them", required=True)
     parser.add_argument('-d', '--database', action='store', dest="database", required=True,
                         help="Specify the directory of the protein database file")
+    parser.add_argument('-i', '--index', action='store', dest="index",
+                        help="Specify the directory of the protein database index created with "
+                             "'protein_index.py build-index'")
+    parser.add_argument('--digest', action='store', dest="digest",
+                        help="Specify the directory of the digest index created with 'protein_index.py build-digest'")
+    parser.add_argument('--fold', action='append', dest="folding", default=[], choices=list(protein_index.FOLDINGS),
+                        help="Match residues that can't be told apart: 'il' (I/L), 'qk' (Q/K) or 'nd' (deamidation "
+                             "N/D), can be given multiple times")
+    parser.add_argument('--mapping', action='store_true', dest="mapping",
+                        help="Also write the protein accessions and positions of every peptide, the digest index "
+                             "isn't used then")
+    parser.add_argument('--max-hits', action='store', dest="max_hits", type=unknown_peptide_seeker.positive_int,
+                        default=unknown_peptide_seeker.MAX_HITS,
+                        help="Maximum number of hits recorded per peptide in the mapping")
+    parser.add_argument('--variants', action='store_true', dest="variants",
+                        help="Also classify the peptides as exact matches, single amino acid variants or novel")
     parser.add_argument('-n', '--name', action='store', dest="name", default="sample",
                         help="Provide a name for the pipeline run")
     parser.add_argument('--left_name', action='store', dest="left_name", default="left",
                         help="Name the left sample")
     parser.add_argument('--right_name', action='store', dest="right_name", default="right",
                         help="Name the right sample")
+    parser.add_argument('--cpu', action='store', dest="cpu", type=int,
+                        help="Provide number of CPUs the pipeline stages may use together")
+    parser.add_argument('--ppm', action='store_true', dest="ppm",
+                        help="Normalise the peptide counts to parts per million of each sample")
+    parser.add_argument('--dense-csv', action='store_true', dest="dense_csv",
+                        help="Also write the peptide counts of each group as a CSV file with a column per sample")
+    parser.add_argument('--force-stage', action='append', dest="force_stages", default=[],
+                        help="Rerun a stage even when its outputs are up to date, can be given multiple times. "
+                             "'all' reruns every stage")
+    parser.add_argument('--sync-writes', action='store_false', dest="async_writes",
+                        help="Write the output files of a stage before starting the stages that depend on it")
+    parser.add_argument('--no-cache', action='store_false', dest="cache",
+                        help="Bypass the cache of cleaned peptide tables")
+    parser.add_argument('--clear-cache', action='store_true', dest="clear_cache",
+                        help="Remove all cached peptide tables before running")
+    parser.add_argument('--cache-size', action='store', dest="cache_size", type=int,
+                        help="Provide the maximum size of the peptide table cache in MB")
     args = parser.parse_args()
 
     try:
         print("Pipeline started at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
         make_directories(args.name)
-        left_data = csv_dataframe.join_dataframes(args.left)
-        right_data = csv_dataframe.join_dataframes(args.right)
-
-        compare_samples(left_data, right_data, args.name, args.left_name, args.right_name, "all")
-
-        find_unknowns(left_data, args.database, args.left_name, args.name)
-        find_unknowns(right_data, args.database, args.right_name, args.name)
-
-        compare_distinct_unknown(args.name, args.left_name)
-        compare_distinct_unknown(args.name, args.right_name)
-
-        create_graph(left_data, right_data, args.left_name, args.right_name, args.name)
-        create_sub_graph(args.name, args.left_name)
-        create_sub_graph(args.name, args.right_name)
-
-        count_peptides(args.left, args.right, args.left_name, args.right_name, args.name)
+        table_cache.configure(enabled=args.cache,
+                              max_size=None if args.cache_size is None else args.cache_size * 1024 ** 2)
+        if args.clear_cache:
+            table_cache.clear()
+        cpu_budget = args.cpu if args.cpu is not None else os.cpu_count()
+        stages = build_stages(args, cpu_budget)
+        try:
+            stage_scheduler.check_force_stages(stages, args.force_stages)
+        except ValueError as e:
+            parser.error(str(e))
+        stage_scheduler.run_stages(stages, cpu_budget,
+                                   manifest_file="output/{}/manifest.json".format(args.name),
+                                   force_stages=args.force_stages, async_writes=args.async_writes)
 
         print("Pipeline finished at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
     except FileNotFoundError as e:
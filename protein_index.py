@@ -0,0 +1,490 @@
+#!/usr/bin/python3
+"""
+Builds a persistent on-disk index of a protein sequence database, so peptides can be looked up without parsing the
+fasta file again. All protein sequences are concatenated into one byte array and a suffix array over that array is
+stored next to it as memory-mappable NumPy files, with the accession of every protein. The index is versioned and
+checksummed against the source fasta file, so a stale index is detected before it is used.
+
+Both can fold the residues mass spectrometry can't tell apart into one letter (I/L to J, optionally Q/K and
+deamidated N/D), peptides are then folded the same way before they are looked up.
+
+A digest index stores the in silico digested peptides of the database as a sorted array of 64-bit hashes, both
+with and without their flanking residues, so most PEAKS peptides are found with a single hash probe.
+
+Commands:
+    build-index     Builds the index of a protein database
+    build-digest    Builds the digest index of a protein database
+    check-index     Verifies whether an existing index still matches its protein database
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+import fasta_reader
+
+INDEX_VERSION = 2
+DIGEST_VERSION = 1
+SEPARATOR = 0
+# Enzymes cleave after the first residues, unless the next residue is one of the blocking residues
+ENZYMES = {
+    "trypsin": (b"KR", b"P"),
+    "trypsin/p": (b"KR", b""),
+    "lys-c": (b"K", b"P"),
+    "lys-c/p": (b"K", b""),
+    "arg-c": (b"R", b"P"),
+    "chymotrypsin": (b"FWY", b"P"),
+}
+# Residues folded into one letter by each folding, applied in this order
+FOLDINGS = {
+    "il": (b"IL", b"JJ"),
+    "qk": (b"Q", b"K"),
+    "nd": (b"N", b"D"),
+}
+HASH_BASE = np.uint64(0x100000001B3)
+# Proteins are digested in batches of about this many residues
+DIGEST_BATCH_SIZE = 16 * 1024 ** 2
+
+
+class StaleIndexError(ValueError):
+    """Raised when an index doesn't match the protein database or the current index version"""
+
+
+def default_index_dir(database_file):
+    """Returns the directory the index of a database is stored in when no other directory is given"""
+    return "{}.index".format(database_file)
+
+
+def fold_names(folding):
+    """Returns the given folding names in the order of FOLDINGS, the form they are stored in"""
+    for name in folding:
+        if name not in FOLDINGS:
+            raise ValueError("Unknown folding {}, choose from {}".format(name, ", ".join(FOLDINGS)))
+    return [name for name in FOLDINGS if name in folding]
+
+
+def fold_table(folding):
+    """Returns the bytes.translate table of the foldings, None when nothing gets folded"""
+    if not folding:
+        return None
+    source = b"".join(FOLDINGS[name][0] for name in fold_names(folding))
+    target = b"".join(FOLDINGS[name][1] for name in fold_names(folding))
+    return bytes.maketrans(source, target)
+
+
+def fold_peptides(peptides, table):
+    """Returns the peptide strings folded with the fold_table"""
+    if table is None:
+        return list(peptides)
+    return [peptide.encode("ascii").translate(table).decode("ascii") for peptide in peptides]
+
+
+def file_checksum(path):
+    """Calculates the sha256 checksum of a file in chunks"""
+    checksum = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def database_stats(database_file):
+    """Returns the path, size, modification time and checksum of the database, taken before it is read"""
+    stat = os.stat(database_file)
+    return {
+        "database": os.path.abspath(database_file),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha256": file_checksum(database_file),
+    }
+
+
+def concatenate_sequences(database_file, table=None):
+    """Concatenates all protein sequences into one byte array, separated by a byte that never occurs in a peptide.
+    The residues get folded when a fold_table is given. Returns the array, the protein offsets and accessions"""
+    sequence = bytearray()
+    offsets = []
+    accessions = []
+    for header, protein in fasta_reader.read_byte_shard(database_file, 0, fasta_reader.UNBOUNDED):
+        offsets.append(len(sequence))
+        accessions.append(fasta_reader.record_accession(header))
+        sequence += protein
+        sequence.append(SEPARATOR)
+    if table is not None:
+        sequence = sequence.translate(table)
+    return np.frombuffer(bytes(sequence), dtype=np.uint8), np.array(offsets, dtype=np.int64), accessions
+
+
+def pack_accessions(accessions):
+    """Packs the accessions into one byte buffer and an offsets array"""
+    encoded = [accession.encode("utf-8") for accession in accessions]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(accession) for accession in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def build_suffix_array(text, depth):
+    """Sorts all suffixes of the text on their first <depth> characters by prefix doubling"""
+    size = len(text)
+    index_type = np.int32 if size < 2 ** 31 else np.int64
+    rank = text.astype(index_type)
+    suffixes = np.argsort(rank, kind="stable").astype(index_type)
+    k = 1
+    while k < depth:
+        next_rank = np.full(size, -1, dtype=index_type)
+        next_rank[:size - k] = rank[k:]
+        suffixes = np.lexsort((next_rank, rank)).astype(index_type)
+        sorted_rank = rank[suffixes]
+        sorted_next = next_rank[suffixes]
+        changed = (sorted_rank[1:] != sorted_rank[:-1]) | (sorted_next[1:] != sorted_next[:-1])
+        rank = np.empty(size, dtype=index_type)
+        rank[suffixes] = np.concatenate(([0], np.cumsum(changed, dtype=index_type)))
+        if rank[suffixes[-1]] == size - 1:
+            break
+        k *= 2
+    return suffixes
+
+
+def build_index(database_file, index_dir=None, depth=64, folding=()):
+    """Creates the index files of a protein database and returns the directory they were written to"""
+    folding = fold_names(folding)
+    if index_dir is None:
+        index_dir = default_index_dir(database_file)
+    try:
+        os.makedirs(index_dir)
+    except FileExistsError:
+        pass
+
+    database_meta = database_stats(database_file)
+    text, offsets, accessions = concatenate_sequences(database_file, fold_table(folding))
+    suffixes = build_suffix_array(text, depth)
+    names, name_offsets = pack_accessions(accessions)
+
+    np.save(os.path.join(index_dir, "sequence.npy"), text)
+    np.save(os.path.join(index_dir, "suffixes.npy"), suffixes)
+    np.save(os.path.join(index_dir, "offsets.npy"), offsets)
+    np.save(os.path.join(index_dir, "accessions.npy"), names)
+    np.save(os.path.join(index_dir, "accession_offsets.npy"), name_offsets)
+    meta = {
+        "version": INDEX_VERSION,
+        **database_meta,
+        "depth": depth,
+        "folding": folding,
+        "proteins": len(offsets),
+        "residues": len(text) - len(offsets),
+    }
+    # The metadata is written last, so an interrupted build never looks like a valid index
+    with open(os.path.join(index_dir, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file, indent=2)
+    return index_dir
+
+
+def check_meta(meta, version, index_dir, database_file, full_checksum=False, command="build-index", folding=None):
+    """Raises a StaleIndexError when the index metadata has another version or folding or belongs to another database
+    file. The folding is only checked when it is given"""
+    if meta.get("version") != version:
+        raise StaleIndexError("Index {} has version {}, expected version {}. Please rebuild it with "
+                              "{}".format(index_dir, meta.get("version"), version, command))
+    if folding is not None and meta.get("folding", []) != fold_names(folding):
+        raise StaleIndexError("Index {} was built with folding '{}' instead of '{}'. Please rebuild it with {} "
+                              "--fold".format(index_dir, ",".join(meta.get("folding", [])),
+                                              ",".join(fold_names(folding)), command))
+    stat = os.stat(database_file)
+    unchanged = stat.st_size == meta["size"] and stat.st_mtime == meta["mtime"]
+    # Only fall back on the slow checksum when the cheap size and time check is inconclusive
+    if (full_checksum or not unchanged) and file_checksum(database_file) != meta["sha256"]:
+        raise StaleIndexError("Index {} is stale, {} has changed since it was built. Please rebuild it with "
+                              "{}".format(index_dir, database_file, command))
+    return meta
+
+
+def check_index(index_dir, database_file, full_checksum=False, folding=None):
+    """Raises a StaleIndexError when the index was built by another version or from another database file"""
+    with open(os.path.join(index_dir, "meta.json"), "r") as meta_file:
+        meta = json.load(meta_file)
+    return check_meta(meta, INDEX_VERSION, index_dir, database_file, full_checksum, folding=folding)
+
+
+def load_index(index_dir, database_file=None, folding=None):
+    """Memory-maps the index files, the index gets checked against the database file and folding when given"""
+    if database_file is not None:
+        meta = check_index(index_dir, database_file, folding=folding)
+    else:
+        with open(os.path.join(index_dir, "meta.json"), "r") as meta_file:
+            meta = json.load(meta_file)
+    return {
+        "meta": meta,
+        "sequence": np.load(os.path.join(index_dir, "sequence.npy"), mmap_mode="r"),
+        "suffixes": np.load(os.path.join(index_dir, "suffixes.npy"), mmap_mode="r"),
+        "offsets": np.load(os.path.join(index_dir, "offsets.npy"), mmap_mode="r"),
+        "accessions": np.load(os.path.join(index_dir, "accessions.npy"), mmap_mode="r"),
+        "accession_offsets": np.load(os.path.join(index_dir, "accession_offsets.npy"), mmap_mode="r"),
+        "table": fold_table(meta.get("folding", [])),
+    }
+
+
+def find_range(index, pattern):
+    """Binary searches the suffix array for the range of suffixes that start with the pattern bytes"""
+    text = index["sequence"]
+    suffixes = index["suffixes"]
+    length = len(pattern)
+
+    low, high = 0, len(suffixes)
+    while low < high:
+        middle = (low + high) // 2
+        position = suffixes[middle]
+        if text[position:position + length].tobytes() < pattern:
+            low = middle + 1
+        else:
+            high = middle
+    start = low
+
+    high = len(suffixes)
+    while low < high:
+        middle = (low + high) // 2
+        position = suffixes[middle]
+        if text[position:position + length].tobytes() <= pattern:
+            low = middle + 1
+        else:
+            high = middle
+    return start, low
+
+
+def find_positions(index, peptide):
+    """Returns the positions in the concatenated sequence at which the peptide occurs"""
+    pattern = peptide.encode("ascii").translate(index["table"])
+    depth = index["meta"]["depth"]
+    start, stop = find_range(index, pattern[:depth])
+    positions = np.asarray(index["suffixes"][start:stop], dtype=np.int64)
+    if len(pattern) > depth:
+        # Suffixes are only sorted on their first <depth> characters, so longer peptides need to be verified
+        text = index["sequence"]
+        positions = np.array([position for position in positions
+                              if text[position:position + len(pattern)].tobytes() == pattern], dtype=np.int64)
+    return positions
+
+
+def contains(index, peptide):
+    """Checks whether the peptide is a substring of any protein in the index"""
+    if len(peptide) > index["meta"]["depth"]:
+        return len(find_positions(index, peptide)) > 0
+    start, stop = find_range(index, peptide.encode("ascii").translate(index["table"]))
+    return stop > start
+
+
+def find_hits(index, peptide, max_hits):
+    """Returns the proteins and start offsets within them of the first <max_hits> occurrences of the peptide, in
+    database order, and the number of occurrences"""
+    positions = np.sort(find_positions(index, peptide))
+    proteins = np.searchsorted(index["offsets"], positions, side="right") - 1
+    return proteins[:max_hits], (positions - index["offsets"][proteins])[:max_hits], len(positions)
+
+
+def protein_accession(index, protein):
+    """Returns the accession of a protein of the index"""
+    offsets = index["accession_offsets"]
+    return index["accessions"][offsets[protein]:offsets[protein + 1]].tobytes().decode("utf-8")
+
+
+def window_hashes(text, starts, lengths):
+    """Returns the 64-bit polynomial hash of every window of the text, computed for all windows at once"""
+    hashes = np.zeros(len(starts), dtype=np.uint64)
+    lengths = np.asarray(lengths)
+    with np.errstate(over='ignore'):
+        for k in range(int(lengths.max()) if len(lengths) else 0):
+            active = lengths > k
+            hashes[active] = hashes[active] * HASH_BASE + text[starts[active] + k].astype(np.uint64)
+        # Mixing in the length keeps windows apart that only differ by leading zero codes
+        hashes ^= lengths.astype(np.uint64) << np.uint64(56)
+    return hashes
+
+
+def peptide_hashes(peptides):
+    """Returns the window_hashes of the peptide strings"""
+    encoded = [peptide.encode("ascii", "replace") for peptide in peptides]
+    lengths = np.array([len(peptide) for peptide in encoded], dtype=np.int64)
+    starts = np.zeros(len(encoded), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    return window_hashes(np.frombuffer(b"".join(encoded), dtype=np.uint8), starts, lengths)
+
+
+def digest_windows(text, starts, enzyme, missed_cleavages, min_length, max_length):
+    """Digests the proteins of a concatenated sequence batch, returns the start and length of every peptide, followed
+    by those of the peptides extended with their flanking residues when both lie within the protein"""
+    cleave_after, blocked_by = ENZYMES[enzyme]
+    cleaves = np.zeros(256, dtype=bool)
+    cleaves[list(cleave_after)] = True
+    blocks = np.zeros(256, dtype=bool)
+    blocks[list(blocked_by)] = True
+    blocks[SEPARATOR] = True
+
+    # A site is the offset a peptide can start or end at: every protein start and end plus every cleavage site
+    positions = np.arange(1, len(text))
+    cleavage = positions[cleaves[text[:-1]] & ~blocks[text[1:]]]
+    ends = np.append(starts[1:] - 1, len(text) - 1)
+    sites = np.unique(np.concatenate([starts, ends, cleavage]))
+    proteins = np.searchsorted(starts, sites, side="right") - 1
+
+    peptide_starts = []
+    peptide_ends = []
+    for step in range(1, missed_cleavages + 2):
+        first, last = sites[:-step], sites[step:]
+        lengths = last - first
+        valid = (proteins[:-step] == proteins[step:]) & (lengths >= min_length) & (lengths <= max_length)
+        peptide_starts.append(first[valid])
+        peptide_ends.append(last[valid])
+    peptide_starts = np.concatenate(peptide_starts)
+    peptide_ends = np.concatenate(peptide_ends)
+    protein_starts = starts[np.searchsorted(starts, peptide_starts, side="right") - 1]
+    flanked = (peptide_starts > protein_starts) & (text[np.minimum(peptide_ends, len(text) - 1)] != SEPARATOR)
+    return (np.concatenate([peptide_starts, peptide_starts[flanked] - 1]),
+            np.concatenate([peptide_ends - peptide_starts, peptide_ends[flanked] - peptide_starts[flanked] + 2]))
+
+
+def iter_protein_batches(database_file):
+    """Yields the proteins of the database concatenated in batches, with the start offset of every protein"""
+    batch = bytearray()
+    starts = []
+    for _, protein in fasta_reader.read_byte_shard(database_file, 0, fasta_reader.UNBOUNDED):
+        starts.append(len(batch))
+        batch += protein
+        batch.append(SEPARATOR)
+        if len(batch) >= DIGEST_BATCH_SIZE:
+            yield np.frombuffer(bytes(batch), dtype=np.uint8), np.array(starts, dtype=np.int64)
+            batch = bytearray()
+            starts = []
+    if starts:
+        yield np.frombuffer(bytes(batch), dtype=np.uint8), np.array(starts, dtype=np.int64)
+
+
+def build_digest(database_file, index_dir=None, enzyme="trypsin", missed_cleavages=2, min_length=6,
+                 max_length=50, folding=()):
+    """Digests the protein database in silico and writes the sorted hashes of its peptides, with and without their
+    flanking residues, as the digest index. Returns the index directory"""
+    folding = fold_names(folding)
+    table = fold_table(folding)
+    if index_dir is None:
+        index_dir = default_index_dir(database_file)
+    if enzyme not in ENZYMES:
+        raise ValueError("Unknown enzyme {}, choose from {}".format(enzyme, ", ".join(ENZYMES)))
+    try:
+        os.makedirs(index_dir)
+    except FileExistsError:
+        pass
+
+    database_meta = database_stats(database_file)
+    hashes = []
+    for text, starts in iter_protein_batches(database_file):
+        windows, lengths = digest_windows(text, starts, enzyme, missed_cleavages, min_length, max_length)
+        # Cleavage sites are found on the original residues, a folded Q would otherwise cleave like K
+        if table is not None:
+            text = np.frombuffer(text.tobytes().translate(table), dtype=np.uint8)
+        hashes.append(np.unique(window_hashes(text, windows, lengths)))
+    hashes = np.unique(np.concatenate(hashes)) if hashes else np.empty(0, dtype=np.uint64)
+    np.save(os.path.join(index_dir, "digest.npy"), hashes)
+    meta = {
+        "version": DIGEST_VERSION,
+        **database_meta,
+        "enzyme": enzyme,
+        "missed_cleavages": missed_cleavages,
+        "min_length": min_length,
+        "max_length": max_length,
+        "folding": folding,
+        "peptides": len(hashes),
+    }
+    with open(os.path.join(index_dir, "digest.json"), "w") as meta_file:
+        json.dump(meta, meta_file, indent=2)
+    return index_dir
+
+
+def load_digest(index_dir, database_file=None, folding=None):
+    """Memory-maps the digest index, it gets checked against the database file and folding when given"""
+    with open(os.path.join(index_dir, "digest.json"), "r") as meta_file:
+        meta = json.load(meta_file)
+    if database_file is not None:
+        check_meta(meta, DIGEST_VERSION, index_dir, database_file, command="build-digest", folding=folding)
+    return {"meta": meta, "hashes": np.load(os.path.join(index_dir, "digest.npy"), mmap_mode="r"),
+            "table": fold_table(meta.get("folding", []))}
+
+
+def digest_contains(digest, peptides):
+    """Returns a boolean array marking the peptides found in the digest index. A hit is exact up to the chance of a
+    64-bit hash collision, a miss only means the peptide isn't a digested peptide"""
+    hashes = peptide_hashes(fold_peptides(peptides, digest["table"]))
+    stored = digest["hashes"]
+    if len(stored) == 0:
+        return np.zeros(len(hashes), dtype=bool)
+    positions = np.minimum(np.searchsorted(stored, hashes), len(stored) - 1)
+    return np.asarray(stored[positions]) == hashes
+
+
+def main(argv):
+    print(' '.join(argv))
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    build_parser = subparsers.add_parser("build-index", help="Build the index of a protein database")
+    build_parser.add_argument('-d', '--database', action='store', dest="database", required=True,
+                              help="Specify the directory of the protein database file")
+    build_parser.add_argument('-i', '--index', action='store', dest="index",
+                              help="Provide an index directory, defaults to '<DATABASE>.index'")
+    build_parser.add_argument('--depth', action='store', dest="depth", type=int, default=64,
+                              help="Number of residues the suffixes get sorted on, longer peptides are verified")
+    build_parser.add_argument('--fold', action='append', dest="folding", default=[], choices=list(FOLDINGS),
+                              help="Fold residues that can't be told apart: 'il' (I/L), 'qk' (Q/K) or 'nd' "
+                                   "(deamidation N/D), can be given multiple times")
+    digest_parser = subparsers.add_parser("build-digest", help="Build the digest index of a protein database")
+    digest_parser.add_argument('-d', '--database', action='store', dest="database", required=True,
+                               help="Specify the directory of the protein database file")
+    digest_parser.add_argument('-i', '--index', action='store', dest="index",
+                               help="Provide an index directory, defaults to '<DATABASE>.index'")
+    digest_parser.add_argument('--enzyme', action='store', dest="enzyme", default="trypsin", choices=sorted(ENZYMES),
+                               help="Specify the enzyme to digest the proteins with")
+    digest_parser.add_argument('--missed-cleavages', action='store', dest="missed_cleavages", type=int, default=2,
+                               help="Maximum number of missed cleavages of a peptide")
+    digest_parser.add_argument('--min-length', action='store', dest="min_length", type=int, default=6,
+                               help="Minimum peptide length")
+    digest_parser.add_argument('--max-length', action='store', dest="max_length", type=int, default=50,
+                               help="Maximum peptide length")
+    digest_parser.add_argument('--fold', action='append', dest="folding", default=[], choices=list(FOLDINGS),
+                               help="Fold residues that can't be told apart: 'il' (I/L), 'qk' (Q/K) or 'nd' "
+                                    "(deamidation N/D), can be given multiple times")
+    check_parser = subparsers.add_parser("check-index", help="Check whether an index matches its protein database")
+    check_parser.add_argument('-d', '--database', action='store', dest="database", required=True,
+                              help="Specify the directory of the protein database file")
+    check_parser.add_argument('-i', '--index', action='store', dest="index",
+                              help="Provide an index directory, defaults to '<DATABASE>.index'")
+    args = parser.parse_args()
+
+    index_dir = args.index if args.index is not None else default_index_dir(args.database)
+    try:
+        print("Started at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
+        if args.command == "build-index":
+            build_index(args.database, index_dir, args.depth, args.folding)
+            print("Index written to {}".format(index_dir))
+        elif args.command == "build-digest":
+            build_digest(args.database, index_dir, args.enzyme, args.missed_cleavages, args.min_length,
+                         args.max_length, args.folding)
+            print("Digest index written to {}".format(index_dir))
+        else:
+            meta = check_index(index_dir, args.database, full_checksum=True)
+            print("Index {} is up to date: {} proteins, {} residues".format(index_dir, meta["proteins"],
+                                                                          meta["residues"]))
+        print("Finished at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
+    except FileNotFoundError as e:
+        print(__doc__)
+        print("Please provide valid files:")
+        print(e)
+        sys.exit(2)
+    except StaleIndexError as e:
+        print(e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+"""
+A small scheduler that runs pipeline stages as a dependency graph. Every stage declares the artifacts it needs and
+the artifacts it produces, stages whose inputs are available run concurrently as long as the CPUs they claim fit
+within the CPU budget.
+Runs are incremental: the output files of every finished stage are recorded in a run manifest together with a
+fingerprint of its parameters, source files and upstream stages. A rerun skips the stages that are still up to date.
+Artifacts are handed to downstream stages in memory, writing them to files is a separate and optionally asynchronous
+step of the stage, so downstream stages don't have to wait for it.
+"""
+import hashlib
+import json
+import multiprocessing as mp
+import os
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# function gets called with the values of the input artifacts in the order of inputs. With one output the return
+# value is that artifact, with more outputs it's a tuple holding them in the order of outputs.
+# params and sources (files the stage reads) make up the fingerprint of the stage, targets are the files it writes.
+# write gets called with the return value of function to write the targets. A stage without targets always runs,
+# a skipped stage gets its output artifacts from load, or None without it.
+Stage = namedtuple('Stage', ['name', 'function', 'inputs', 'outputs', 'cpus', 'params', 'sources', 'targets', 'write',
+                             'load'],
+                   defaults=(None, (), (), None, None))
+
+
+def pool_context():
+    """Returns the multiprocessing context for the process pools started inside a stage. Stages run on threads of
+    the scheduler and forking a process with running threads can copy a lock held by another thread into the child,
+    so the pools are started from a fork server, or spawned where there is none"""
+    return mp.get_context("forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn")
+
+
+def check_stages(stages):
+    """Raises a ValueError when stages share a name, an input is never produced or the stages contain a cycle"""
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError("Stage names have to be unique: {}".format(", ".join(names)))
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            if output in producers:
+                raise ValueError("Artifact '{}' is produced by both '{}' and '{}'"
+                                 .format(output, producers[output].name, stage.name))
+            producers[output] = stage
+    for stage in stages:
+        for artifact in stage.inputs:
+            if artifact not in producers:
+                raise ValueError("Stage '{}' needs artifact '{}' which no stage produces".format(stage.name, artifact))
+
+    available = set()
+    remaining = list(stages)
+    while remaining:
+        ready = [stage for stage in remaining if all(artifact in available for artifact in stage.inputs)]
+        if not ready:
+            raise ValueError("Stages contain a dependency cycle: {}"
+                             .format(", ".join(stage.name for stage in remaining)))
+        for stage in ready:
+            available.update(stage.outputs)
+            remaining.remove(stage)
+    return producers
+
+
+def file_signature(path):
+    """Returns the absolute path, size and modification time of a file, or None when it doesn't exist"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def stage_fingerprint(stage, upstream):
+    """Hashes the parameters and source files of a stage with the fingerprints and generations of its upstream
+    stages, the generation of a stage goes up every time it actually runs"""
+    content = {
+        "name": stage.name,
+        "params": stage.params,
+        "sources": [file_signature(path) for path in stage.sources],
+        "upstream": upstream,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load_manifest(manifest_file):
+    if manifest_file is None:
+        return {}
+    try:
+        with open(manifest_file, "r") as manifest:
+            return json.load(manifest)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_manifest(manifest_file, manifest):
+    """Replaces the manifest in one go, so a crash never leaves a partially written manifest behind"""
+    if manifest_file is None:
+        return
+    temp_file = manifest_file + ".tmp"
+    with open(temp_file, "w") as manifest_data:
+        json.dump(manifest, manifest_data, indent=2, sort_keys=True)
+    os.replace(temp_file, manifest_file)
+
+
+def is_up_to_date(stage, fingerprint, manifest):
+    """Checks whether the stage ran before with the same fingerprint and its targets haven't changed since"""
+    record = manifest.get(stage.name)
+    if not stage.targets or record is None or record["fingerprint"] != fingerprint:
+        return False
+    return all(file_signature(path) is not None and file_signature(path) == record["targets"].get(path)
+               for path in stage.targets)
+
+
+def record_stage(stage, fingerprint, generation, manifest, manifest_file):
+    """Adds the finished stage and the current state of its targets to the manifest"""
+    if stage.targets:
+        manifest[stage.name] = {
+            "fingerprint": fingerprint,
+            "generation": generation,
+            "targets": {path: file_signature(path) for path in stage.targets},
+        }
+        write_manifest(manifest_file, manifest)
+
+
+def store_outputs(stage, result, artifacts):
+    if len(stage.outputs) == 1:
+        artifacts[stage.outputs[0]] = result
+    elif stage.outputs:
+        for artifact, value in zip(stage.outputs, result):
+            artifacts[artifact] = value
+
+
+def check_force_stages(stages, force_stages):
+    """Raises a ValueError when a forced stage name is neither a stage nor 'all', so a typo doesn't go unnoticed"""
+    names = [stage.name for stage in stages]
+    unknown = [name for name in force_stages if name != "all" and name not in names]
+    if unknown:
+        raise ValueError("Unknown stage {} to force, choose from all, {}".format(", ".join(unknown), ", ".join(names)))
+
+
+def run_stages(stages, cpu_budget, manifest_file=None, force_stages=(), async_writes=True):
+    """Runs every stage once its inputs are available and its CPUs fit within the budget, returns the artifacts
+
+    Stages that are up to date according to the manifest are skipped, unless they are named in force_stages
+    ('all' forces every stage). With async_writes downstream stages may start while the targets are being written."""
+    producers = check_stages(stages)
+    check_force_stages(stages, force_stages)
+    manifest = load_manifest(manifest_file)
+    artifacts = {}
+    fingerprints = {}
+    generations = {}
+    pending = list(stages)
+    running = {}
+    cpus_in_use = 0
+
+    with ThreadPoolExecutor(max_workers=max(2 * len(stages), 1)) as executor:
+        while pending or running:
+            # Stages are started in the order they were declared in, smaller stages may fill up the leftover CPUs
+            for stage in list(pending):
+                if not all(artifact in artifacts for artifact in stage.inputs):
+                    continue
+                upstream = sorted({(fingerprints[producers[artifact].name], generations[producers[artifact].name])
+                                   for artifact in stage.inputs})
+                fingerprint = stage_fingerprint(stage, upstream)
+                forced = "all" in force_stages or stage.name in force_stages
+                if not forced and is_up_to_date(stage, fingerprint, manifest):
+                    print("Skipping {}, its outputs are up to date".format(stage.name))
+                    pending.remove(stage)
+                    fingerprints[stage.name] = fingerprint
+                    generations[stage.name] = manifest[stage.name].get("generation", 0)
+                    store_outputs(stage, stage.load() if stage.load is not None else
+                                  (None if len(stage.outputs) < 2 else [None] * len(stage.outputs)), artifacts)
+                    continue
+
+                cpus = min(max(stage.cpus, 1), cpu_budget)
+                if cpus_in_use + cpus > cpu_budget:
+                    continue
+                pending.remove(stage)
+                cpus_in_use += cpus
+                future = executor.submit(stage.function, *[artifacts[artifact] for artifact in stage.inputs])
+                running[future] = (stage, cpus, fingerprint, False)
+
+            if not running:
+                # Skipped stages made new inputs available, the next pass can start the stages waiting on them
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, cpus, fingerprint, is_write = running.pop(future)
+                cpus_in_use -= cpus
+                result = future.result()
+                if is_write:
+                    record_stage(stage, fingerprint, generations[stage.name], manifest, manifest_file)
+                    continue
+
+                store_outputs(stage, result, artifacts)
+                fingerprints[stage.name] = fingerprint
+                generations[stage.name] = manifest.get(stage.name, {}).get("generation", 0) + 1 \
+                    if stage.targets else 0
+                if stage.write is None:
+                    record_stage(stage, fingerprint, generations[stage.name], manifest, manifest_file)
+                elif async_writes:
+                    # Writing doesn't count towards the CPU budget, the stage is recorded once it is written
+                    running[executor.submit(stage.write, result)] = (stage, 0, fingerprint, True)
+                else:
+                    stage.write(result)
+                    record_stage(stage, fingerprint, generations[stage.name], manifest, manifest_file)
+    return artifacts
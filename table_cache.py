@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+"""
+A content-addressed cache of cleaned peptide tables, so every input CSV file only gets parsed and cleaned once.
+Tables are stored as uncompressed NumPy .npz files with text columns packed into one byte buffer plus offsets.
+Entries are named after the sha256 of the file content and the loader options, the content hash of a path is
+remembered together with its size and modification time. The least recently used tables are removed once the cache
+grows beyond its size limit.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+settings = {
+    "directory": os.path.join("output", "cache"),
+    "max_size": 2 * 1024 ** 3,
+    "enabled": True,
+}
+
+
+def configure(directory=None, max_size=None, enabled=None):
+    """Changes the cache settings, arguments that are None keep their current value"""
+    if directory is not None:
+        settings["directory"] = directory
+    if max_size is not None:
+        settings["max_size"] = max_size
+    if enabled is not None:
+        settings["enabled"] = enabled
+
+
+def current_settings():
+    """Returns the settings as configure arguments, e.g. to pass them on to a process pool initializer"""
+    return settings["directory"], settings["max_size"], settings["enabled"]
+
+
+def make_directories():
+    for sub_dir in ("paths", "tables"):
+        try:
+            os.makedirs(os.path.join(settings["directory"], sub_dir))
+        except FileExistsError:
+            pass
+
+
+def replace_file(path, write):
+    """Writes a file through a temporary file, so concurrent readers never see a partially written file"""
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_path, "wb") as temp_file:
+        write(temp_file)
+    os.replace(temp_path, path)
+
+
+def content_hash(input_file):
+    """Returns the sha256 of the file content, reusing the stored hash while its size and mtime are unchanged"""
+    path = os.path.abspath(input_file)
+    stat = os.stat(path)
+    record_file = os.path.join(settings["directory"], "paths", hashlib.sha1(path.encode()).hexdigest() + ".json")
+    try:
+        with open(record_file, "r") as record_data:
+            record = json.load(record_data)
+        if record["path"] == path and record["size"] == stat.st_size and record["mtime"] == stat.st_mtime_ns:
+            return record["sha256"]
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    checksum = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            checksum.update(chunk)
+    record = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": checksum.hexdigest()}
+    replace_file(record_file, lambda record_data: record_data.write(json.dumps(record).encode()))
+    return record["sha256"]
+
+
+def table_path(input_file, options):
+    """Returns the cache file of the input file loaded with the given options"""
+    option_hash = hashlib.sha1(json.dumps(options, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(settings["directory"], "tables", "{}-{}.npz".format(content_hash(input_file), option_hash))
+
+
+def pack_text(values):
+    """Packs a text column into one utf-8 byte buffer, an offsets array and a missing value mask"""
+    missing = pd.isna(values).values
+    encoded = [b"" if is_missing else str(value).encode("utf-8") for value, is_missing in zip(values, missing)]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets, missing
+
+
+def unpack_text(buffer, offsets, missing):
+    buffer = buffer.tobytes()
+    values = np.array([buffer[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])],
+                      dtype=object)
+    values[missing] = np.nan
+    return values
+
+
+def encode_table(table):
+    """Converts a dataframe into named NumPy arrays"""
+    arrays = {}
+    layout = []
+    for number, column in enumerate(table.columns):
+        key = "c{}".format(number)
+        values = table[column]
+        if isinstance(values.dtype, pd.api.types.CategoricalDtype):
+            kind = "category"
+            arrays[key + ".codes"] = values.cat.codes.values
+            arrays[key + ".data"], arrays[key + ".offsets"], arrays[key + ".missing"] = \
+                pack_text(pd.Series(values.cat.categories))
+        elif values.dtype == object:
+            kind = "text"
+            arrays[key + ".data"], arrays[key + ".offsets"], arrays[key + ".missing"] = pack_text(values)
+        else:
+            kind = "array"
+            arrays[key] = values.values
+        layout.append([column, kind])
+    arrays["layout"] = np.array(json.dumps(layout))
+    return arrays
+
+
+def decode_table(arrays):
+    """Converts the named NumPy arrays of encode_table back into a dataframe"""
+    columns = {}
+    layout = json.loads(str(arrays["layout"]))
+    for number, (column, kind) in enumerate(layout):
+        key = "c{}".format(number)
+        if kind == "category":
+            categories = unpack_text(arrays[key + ".data"], arrays[key + ".offsets"], arrays[key + ".missing"])
+            columns[column] = pd.Categorical.from_codes(arrays[key + ".codes"], categories)
+        elif kind == "text":
+            columns[column] = unpack_text(arrays[key + ".data"], arrays[key + ".offsets"], arrays[key + ".missing"])
+        else:
+            columns[column] = arrays[key]
+    return pd.DataFrame(columns, columns=[column for column, _ in layout])
+
+
+def load_table(input_file, options):
+    """Returns the cached table of the input file, or None when it isn't cached"""
+    if not settings["enabled"]:
+        return None
+    make_directories()
+    path = table_path(input_file, options)
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            table = decode_table({key: data[key] for key in data.files})
+    except (FileNotFoundError, ValueError, KeyError, OSError):
+        return None
+    # The modification time of an entry is its last use, used for the LRU eviction
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return table
+
+
+def store_table(input_file, options, table):
+    """Adds the table of the input file to the cache and evicts the least recently used entries when needed"""
+    if not settings["enabled"]:
+        return
+    make_directories()
+    arrays = encode_table(table)
+    replace_file(table_path(input_file, options), lambda table_file: np.savez(table_file, **arrays))
+    evict(settings["max_size"])
+
+
+def cached_entries():
+    """Returns (last use, size, path) of every table in the cache, least recently used first"""
+    table_dir = os.path.join(settings["directory"], "tables")
+    entries = []
+    try:
+        names = os.listdir(table_dir)
+    except FileNotFoundError:
+        return entries
+    for name in names:
+        if not name.endswith(".npz"):
+            continue
+        path = os.path.join(table_dir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    return sorted(entries)
+
+
+def evict(max_size):
+    """Removes the least recently used tables until the cache fits within max_size bytes"""
+    entries = cached_entries()
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def clear():
+    """Removes every table and path record from the cache"""
+    for sub_dir in ("paths", "tables"):
+        directory = os.path.join(settings["directory"], sub_dir)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            continue
+        for name in names:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+def main(argv):
+    print(' '.join(argv))
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--cache-dir', action='store', dest="cache_dir", default=settings["directory"],
+                        help="Specify the directory of the peptide table cache")
+    parser.add_argument('--clear', action='store_true', dest="clear",
+                        help="Remove all cached peptide tables")
+    args = parser.parse_args()
+
+    configure(directory=args.cache_dir)
+    if args.clear:
+        clear()
+    entries = cached_entries()
+    print("{} cached tables, {:.1f} MB".format(len(entries), sum(size for _, size, _ in entries) / 1024 ** 2))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -2,38 +2,317 @@
 """
 A module that checks how many peptides from the PEAKS protein-peptide match results can be found in
 existing protein sequence databases and filters the unknown peptides to a separate file.
+With --fold the peptides and the database are both folded into a reduced alphabet first, so a peptide that only differs
+from the database by I/L (or Q/K, N/D) is known. The unknown peptides are written as they were found.
+With --mapping every protein accession a peptide occurs in is written as well, with the start and end of the peptide
+in the protein, to a columnar .npz file next to the unknown peptides.
+With --variants every unknown peptide is also searched with one mismatch allowed, to tell single amino acid variants
+of known proteins apart from novel peptides.
 """
 import argparse
 import datetime
-import multiprocessing as mp
 import os
 import sys
+from multiprocessing import shared_memory
 
 import numpy as np
-from Bio import SeqIO
+import pandas as pd
 
+import aho_corasick
 import csv_dataframe
+import fasta_reader
+import protein_index
+import stage_scheduler
+import table_cache
+
+# Number of occurrences of a peptide that get recorded in the mapping
+MAX_HITS = 100
+# Shortest exact seed of the single mismatch search, shorter seeds hit too many places in the database
+MIN_SEED_LENGTH = 5
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+# Peptides, automaton, flag bitmap and fold table of a pool worker, attached once by init_worker
+worker_state = {}
+
+
+def share_peptides(peptides):
+    """Packs the peptide sequences into shared memory as one byte buffer plus an offsets array, next to a shared
+    flag bitmap in which every peptide starts out as unknown"""
+    encoded = [peptide.encode("ascii") for peptide in peptides]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(peptide) for peptide in encoded], out=offsets[1:])
+
+    blocks = {
+        "sequences": shared_memory.SharedMemory(create=True, size=max(int(offsets[-1]), 1)),
+        "offsets": shared_memory.SharedMemory(create=True, size=offsets.nbytes),
+        "flags": shared_memory.SharedMemory(create=True, size=max(len(encoded), 1)),
+    }
+    blocks["sequences"].buf[:offsets[-1]] = b"".join(encoded)
+    np.ndarray(offsets.shape, dtype=np.int64, buffer=blocks["offsets"].buf)[:] = offsets
+    np.ndarray((len(encoded),), dtype=np.uint8, buffer=blocks["flags"].buf)[:] = 1
+    return blocks
+
+
+def attach_peptides(names, count):
+    """Attaches to the shared peptide blocks and returns the blocks, the sequence buffer, the offsets array and the
+    flag bitmap. The peptides stay in the shared buffer, see shared_peptide"""
+    blocks = {key: shared_memory.SharedMemory(name=name) for key, name in names.items()}
+    offsets = np.ndarray((count + 1,), dtype=np.int64, buffer=blocks["offsets"].buf)
+    flags = np.ndarray((count,), dtype=np.uint8, buffer=blocks["flags"].buf)
+    return blocks, blocks["sequences"].buf, offsets, flags
+
+
+def shared_peptide(sequences, offsets, i):
+    """Decodes peptide <i> from the shared sequence buffer"""
+    return bytes(sequences[offsets[i]:offsets[i + 1]]).decode("ascii")
+
+
+def shared_peptides(sequences, offsets):
+    """Decodes the shared peptides one at a time, so only the automaton keeps them"""
+    for i in range(len(offsets) - 1):
+        yield shared_peptide(sequences, offsets, i)
+
+
+def init_worker(names, count, table=None):
+    """Pool initializer that compiles the automaton of the shared peptides once per worker"""
+    blocks, sequences, offsets, flags = attach_peptides(names, count)
+    worker_state["blocks"] = blocks
+    worker_state["flags"] = flags
+    worker_state["automaton"] = aho_corasick.build_automaton(shared_peptides(sequences, offsets))
+    worker_state["table"] = table
 
 
 def search_peptide_db(arguments):
-    """Checks for presence of peptides in protein database and notes them down in a boolean list"""
-    peptide_data, database_file, n, offset = arguments
-
-    with open(database_file, "r") as database:
-        count = 1
-        flag_list = [1] * len(peptide_data.index)
-        for record in SeqIO.parse(database, "fasta"):
-            if (count - offset) % n == 0:
-                for i, row in peptide_data.iterrows():
-                    peptide = row['Peptide']
-                    if peptide in record.seq:
-                        flag_list[i] = 0
-            count += 1
+    """Checks for presence of the shared peptides in one byte range of the protein database and marks the found
+    ones in the shared flag bitmap. Unless max_hits is None it also returns the hits of the byte range: the
+    accessions of the proteins with hits, the peptide, protein, start and end of the first <max_hits> hits of every
+    peptide and the number of hits of every peptide"""
+    database_file, start, end, max_hits = arguments
+    automaton = worker_state["automaton"]
+    flags = worker_state["flags"]
+    table = worker_state["table"]
+    accessions = []
+    hits = []
+    counts = np.zeros(len(flags), dtype=np.int64)
+
+    for header, sequence in fasta_reader.read_byte_shard(database_file, start, end):
+        if table is not None:
+            sequence = sequence.translate(table)
+        sequence = sequence.decode("ascii", "replace")
+        if max_hits is None:
+            for i in aho_corasick.search(automaton, sequence):
+                flags[i] = 0
+            continue
+        protein = None
+        for position, length, indices in aho_corasick.iter_matches(automaton, sequence):
+            for i in indices:
+                flags[i] = 0
+                counts[i] += 1
+                # An empty peptide matches every protein without a position
+                if length and counts[i] <= max_hits:
+                    if protein is None:
+                        protein = len(accessions)
+                        accessions.append(fasta_reader.record_accession(header))
+                    hits.append((i, protein, position + 1 - length, position + 1))
+    if max_hits is not None:
+        return accessions, np.array(hits, dtype=np.int64).reshape(-1, 4), counts
+
+
+def search_peptide_index(peptide_data, index_dir, database_file, folding=()):
+    """Checks for presence of peptides in the prebuilt protein database index, no fasta parsing needed"""
+    index = protein_index.load_index(index_dir, database_file, folding)
+    flag_list = [1] * len(peptide_data)
+    for i, peptide in enumerate(peptide_data.peptides()):
+        if protein_index.contains(index, peptide):
+            flag_list[i] = 0
     return flag_list
 
 
+def peptide_seeds(peptides, alphabet=AMINO_ACIDS):
+    """Returns the seeds to extend to single mismatch hits, the peptide of every seed and its offset in the peptide.
+    A peptide with at most one mismatch matches one of its halves exactly, so peptides of at least twice
+    MIN_SEED_LENGTH are split into their halves. Shorter peptides would give seeds found all over the database, their
+    seeds are every substitution of one residue by another residue of the alphabet instead. Peptides shorter than
+    MIN_SEED_LENGTH aren't searched"""
+    seeds = []
+    seed_peptides = []
+    seed_offsets = []
+    for i, peptide in enumerate(peptides):
+        if len(peptide) >= 2 * MIN_SEED_LENGTH:
+            half = len(peptide) // 2
+            candidates = ((0, peptide[:half]), (half, peptide[half:]))
+        elif len(peptide) >= MIN_SEED_LENGTH:
+            candidates = ((0, peptide[:k] + residue + peptide[k + 1:]) for k in range(len(peptide))
+                          for residue in alphabet if residue != peptide[k])
+        else:
+            continue
+        for offset, seed in candidates:
+            seeds.append(seed)
+            seed_peptides.append(i)
+            seed_offsets.append(offset)
+    return seeds, seed_peptides, seed_offsets
+
+
+def init_variant_worker(names, count, table=None):
+    """Pool initializer that compiles the automaton of the seeds of the shared peptides once per worker"""
+    blocks, sequences, offsets, flags = attach_peptides(names, count)
+    peptides = shared_peptides(sequences, offsets)
+    alphabet = sorted(set(protein_index.fold_peptides([AMINO_ACIDS], table)[0]))
+    seeds, seed_peptides, seed_offsets = peptide_seeds(protein_index.fold_peptides(peptides, table), alphabet)
+    worker_state["blocks"] = blocks
+    worker_state["sequences"] = sequences
+    worker_state["offsets"] = offsets
+    worker_state["automaton"] = aho_corasick.build_automaton(seeds)
+    worker_state["seed_peptides"] = seed_peptides
+    worker_state["seed_offsets"] = seed_offsets
+    worker_state["table"] = table
+
+
+def search_variant_db(arguments):
+    """Extends the seed hits in one byte range of the protein database to the whole peptide. Returns the first
+    single mismatch hit of every peptide with one, the first protein and the smallest start within it: the peptide,
+    accession, start in the protein, position of the mismatch in the peptide, the residue of the protein and the
+    residue of the peptide"""
+    database_file, start, end = arguments
+    automaton = worker_state["automaton"]
+    sequences = worker_state["sequences"]
+    offsets = worker_state["offsets"]
+    seed_peptides = worker_state["seed_peptides"]
+    seed_offsets = worker_state["seed_offsets"]
+    table = worker_state["table"]
+    variants = {}
+
+    for header, sequence in fasta_reader.read_byte_shard(database_file, start, end):
+        text = (sequence if table is None else sequence.translate(table)).decode("ascii", "replace")
+        # Hits are reported by end position, the hit with the smallest start in the protein wins
+        protein_variants = {}
+        for position, length, indices in aho_corasick.iter_matches(automaton, text):
+            for seed in indices:
+                i = seed_peptides[seed]
+                begin = position + 1 - length - seed_offsets[seed]
+                if i in variants or begin < 0 or (i in protein_variants and protein_variants[i][0] <= begin):
+                    continue
+                peptide = shared_peptide(sequences, offsets, i)
+                folded = peptide if table is None else peptide.encode("ascii").translate(table).decode("ascii")
+                if begin + len(folded) > len(text):
+                    continue
+                window = text[begin:begin + len(folded)]
+                mismatches = [k for k, (residue, reference) in enumerate(zip(folded, window)) if residue != reference]
+                if len(mismatches) == 1:
+                    k = mismatches[0]
+                    protein_variants[i] = (begin, k, peptide[k])
+        if protein_variants:
+            accession = fasta_reader.record_accession(header)
+            for i, (begin, k, residue) in protein_variants.items():
+                variants[i] = (accession, begin + 1, k + 1, chr(sequence[begin + k]), residue)
+    return variants
+
+
+def search_variants(peptides, database_file, cpu, folding=()):
+    """Searches <cpu> byte ranges of the protein database at once for the peptides with one mismatch allowed, returns
+    per peptide index with a hit the first hit in database order, as given by search_variant_db"""
+    blocks = share_peptides(peptides)
+    try:
+        names = {key: block.name for key, block in blocks.items()}
+        shards = fasta_reader.shard_offsets(database_file, cpu)
+        with stage_scheduler.pool_context().Pool(processes=cpu, initializer=init_variant_worker,
+                                                 initargs=(names, len(peptides),
+                                                           protein_index.fold_table(folding))) as pool:
+            shard_variants = pool.map(search_variant_db, [(database_file, start, end) for start, end in shards])
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+
+    variants = {}
+    for shard in shard_variants:
+        for i, variant in shard.items():
+            variants.setdefault(i, variant)
+    return variants
+
+
+def classify_peptides(peptide_data, merged_flag_list, database_file, cpu, folding=()):
+    """Classifies every peptide as an exact match, a single amino acid variant of a database protein or novel.
+    Variants get the accession and 1-based start of the protein they vary from, the 1-based position of the
+    substitution in the peptide and the reference and variant residue"""
+    # After reset_index the row labels of the first rows of the peptides are their positions in the flags
+    distinct = peptide_data.reset_index().unique()
+    table = pd.DataFrame({'Peptide': distinct.peptides(),
+                          'Unknown': np.asarray(merged_flag_list, dtype=bool)[distinct.index]})
+    unknown = table.index[table['Unknown']]
+    variants = search_variants(table['Peptide'][unknown].tolist(), database_file, cpu, folding)
+
+    table['Match'] = np.where(table['Unknown'], "novel", "exact").astype(object)
+    columns = ['Accession', 'Start', 'Position', 'Reference', 'Variant']
+    rows = np.asarray(unknown[list(variants)], dtype=np.int64)
+    table.loc[rows, 'Match'] = "variant"
+    values = list(zip(*variants.values())) if variants else [()] * len(columns)
+    for column, column_values in zip(columns, values):
+        table[column] = np.full(len(table), None, dtype=object)
+        table.loc[rows, column] = np.array(column_values, dtype=object)
+    return table[['Peptide', 'Match'] + columns]
+
+
+def variant_file(prefix, directory):
+    return "output/{}/unknown_peptides/{}_variants.csv".format(directory, prefix)
+
+
+def write_variant_peptides(variant_data, prefix, directory):
+    """Writes the peptide classification of classify_peptides to a new csv file"""
+    with open(variant_file(prefix, directory), "w") as variant_pep_file:
+        variant_data.to_csv(variant_pep_file, sep=',', mode='w', index=False, header=True, line_terminator='\n')
+
+
+def search_index_hits(peptide_data, index_dir, database_file, folding=(), max_hits=MAX_HITS):
+    """Looks the peptides up in the protein database index, returns the flags of the unknown peptides and the hits
+    like search_peptide_db"""
+    index = protein_index.load_index(index_dir, database_file, folding)
+    hits = []
+    counts = np.zeros(len(peptide_data), dtype=np.int64)
+    for i, peptide in enumerate(peptide_data.peptides()):
+        proteins, starts, counts[i] = protein_index.find_hits(index, peptide, max_hits)
+        hits.extend((i, protein, start, start + len(peptide)) for protein, start in zip(proteins, starts))
+    hits = np.array(hits, dtype=np.int64).reshape(-1, 4)
+    # Only the proteins with hits are kept, numbered in database order
+    proteins, hits[:, 1] = np.unique(hits[:, 1], return_inverse=True)
+    accessions = [protein_index.protein_accession(index, protein) for protein in proteins]
+    return counts == 0, (accessions, hits, counts)
+
+
+def merge_hits(peptides, shard_hits, max_hits):
+    """Merges the hits of the database shards, in database order, into the columnar peptide mapping: per peptide
+    the offsets of its hits in the protein, start and end columns (CSR style), capped at <max_hits> hits"""
+    accessions = []
+    hits = [np.empty((0, 4), dtype=np.int64)]
+    counts = np.zeros(len(peptides), dtype=np.int64)
+    for shard_accessions, shard_hits_array, shard_counts in shard_hits:
+        shard_hits_array = shard_hits_array.copy()
+        shard_hits_array[:, 1] += len(accessions)
+        accessions += shard_accessions
+        hits.append(shard_hits_array)
+        counts += shard_counts
+    hits = np.concatenate(hits)
+    hits = hits[np.argsort(hits[:, 0], kind="stable")]
+
+    offsets = np.zeros(len(peptides) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(hits[:, 0], minlength=len(peptides)), out=offsets[1:])
+    rank = np.arange(len(hits)) - offsets[hits[:, 0]]
+    hits = hits[rank < max_hits]
+    offsets[1:] = np.cumsum(np.minimum(np.diff(offsets), max_hits))
+    return {
+        "peptides": list(peptides),
+        "accessions": accessions,
+        "offsets": offsets,
+        "protein": hits[:, 1],
+        "start": hits[:, 2] + 1,
+        "end": hits[:, 3],
+        "hits": counts,
+    }
+
+
 def merge_flags(flags):
-    """Merges the boolean lists of the separate processes into 1 list"""
+    """Merges the boolean lists of the separate database shards into 1 list"""
     for i in range(len(flags)):
         flags[i] = np.array(flags[i], dtype=bool)
 
@@ -43,14 +322,128 @@ def merge_flags(flags):
     return merged_flag_list
 
 
-def write_unknown_peptide_data(peptide_data, merged_flag_list, prefix, directory):
-    """Writes filtered dataframe to a new csv file"""
+def search_peptides(peptide_data, database_file, cpu, index_dir=None, digest_dir=None, folding=()):
+    """Searches the protein database for the peptides, split over <cpu> byte ranges of the database, and returns a
+    boolean array flagging the unknown peptides. Peptides found in the digest index skip the database search, empty
+    peptides aren't searched and are unknown"""
+    empty = peptide_data.lengths() == 0
+    if empty.any():
+        merged_flag_list = np.ones(len(empty), dtype=bool)
+        if not empty.all():
+            merged_flag_list[~empty] = search_peptides(peptide_data[~empty], database_file, cpu, index_dir,
+                                                       digest_dir, folding)
+        return merged_flag_list
+    if digest_dir is not None:
+        digest = protein_index.load_digest(digest_dir, database_file, folding)
+        known = protein_index.digest_contains(digest, peptide_data.peptides())
+        print("{} peptides found in the digest index, {} peptides searched in the database".format(
+            int(known.sum()), int((~known).sum())))
+        merged_flag_list = np.zeros(len(known), dtype=bool)
+        if not known.all():
+            merged_flag_list[~known] = search_peptides(peptide_data[~known], database_file, cpu, index_dir,
+                                                       folding=folding)
+        return merged_flag_list
+    if index_dir is not None:
+        return merge_flags([search_peptide_index(peptide_data, index_dir, database_file, folding)])
+
+    return scan_database(peptide_data.peptides(), database_file, cpu, folding)[0]
+
+
+def scan_database(peptides, database_file, cpu, folding=(), max_hits=None):
+    """Scans <cpu> byte ranges of the protein database for the peptides at once, returns the flags of the unknown
+    peptides and unless max_hits is None the hits of every shard"""
+    count = len(peptides)
+    table = protein_index.fold_table(folding)
+    blocks = share_peptides(protein_index.fold_peptides(peptides, table))
+    try:
+        names = {key: block.name for key, block in blocks.items()}
+        shards = fasta_reader.shard_offsets(database_file, cpu)
+        with stage_scheduler.pool_context().Pool(processes=cpu, initializer=init_worker,
+                                                 initargs=(names, count, table)) as pool:
+            shard_hits = pool.map(search_peptide_db, [(database_file, start, end, max_hits) for start, end in shards])
+        merged_flag_list = np.ndarray((count,), dtype=np.uint8, buffer=blocks["flags"].buf).astype(bool)
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+    return merged_flag_list, shard_hits
+
+
+def map_peptides(peptide_data, database_file, cpu, index_dir=None, folding=(), max_hits=MAX_HITS):
+    """Searches the protein database like search_peptides and also records where the peptides occur, returns the
+    flags of the unknown peptides and the peptide mapping of merge_hits. Empty peptides aren't searched, so both
+    searches give them no hits"""
+    # Positions of the searched peptides among all peptides
+    searched = np.flatnonzero(peptide_data.lengths() > 0)
+    if index_dir is not None:
+        flags, hits = search_index_hits(peptide_data[searched], index_dir, database_file, folding, max_hits)
+        shard_hits = [hits]
+    else:
+        flags, shard_hits = scan_database(peptide_data[searched].peptides(), database_file, cpu, folding, max_hits)
+
+    merged_flag_list = np.ones(len(peptide_data), dtype=bool)
+    merged_flag_list[searched] = flags
+    for shard, (accessions, hits, counts) in enumerate(shard_hits):
+        all_counts = np.zeros(len(peptide_data), dtype=np.int64)
+        all_counts[searched] = counts
+        hits = hits.copy()
+        hits[:, 0] = searched[hits[:, 0]]
+        shard_hits[shard] = (accessions, hits, all_counts)
+    return merged_flag_list, merge_hits(peptide_data.peptides(), shard_hits, max_hits)
+
+
+def positive_int(value):
+    """Argparse type of the hit cap, which has to be at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive number".format(value))
+    return number
+
+
+def mapping_file(prefix, directory):
+    return "output/{}/unknown_peptides/{}_mapping.npz".format(directory, prefix)
+
+
+def write_peptide_mapping(mapping, prefix, directory):
+    """Stores the peptide mapping in an uncompressed .npz file, with the peptides and accessions packed into byte
+    buffers. Starts and ends are 1-based positions in the protein, hits is the number of hits before the cap"""
+    peptides, peptide_offsets, missing = table_cache.pack_text(pd.Series(mapping["peptides"], dtype=object))
+    accessions, accession_offsets, _ = table_cache.pack_text(pd.Series(mapping["accessions"], dtype=object))
+    with open(mapping_file(prefix, directory), "wb") as output:
+        np.savez(output, peptides=peptides, peptide_offsets=peptide_offsets, missing=missing,
+                 accessions=accessions, accession_offsets=accession_offsets, offsets=mapping["offsets"],
+                 protein=mapping["protein"], start=mapping["start"], end=mapping["end"], hits=mapping["hits"])
+
+
+def read_peptide_mapping(input_file):
+    """Reads a peptide mapping written by write_peptide_mapping"""
+    with np.load(input_file, allow_pickle=False) as data:
+        mapping = {key: data[key] for key in ("offsets", "protein", "start", "end", "hits")}
+        mapping["peptides"] = table_cache.unpack_text(data['peptides'], data['peptide_offsets'], data['missing'])
+        mapping["accessions"] = table_cache.unpack_text(data['accessions'], data['accession_offsets'],
+                                                        np.zeros(len(data['accession_offsets']) - 1, dtype=bool))
+    return mapping
+
+
+def filter_unknown_peptides(peptide_data, merged_flag_list):
+    """Returns the peptides that weren't found in the protein database"""
+    return peptide_data[merged_flag_list]
+
+
+def write_unknown_peptides(unknown_data, prefix, directory):
+    """Writes the table of unknown peptides to a new csv file"""
     output = "output/{}/unknown_peptides/{}_unknown.csv".format(directory, prefix)
 
     with open(output, "w") as unknown_pep_file:
-        filtered_df = peptide_data[merged_flag_list]
-        filtered_df.to_csv(unknown_pep_file, sep=',', mode='w', header=True,
-                           line_terminator='\n')
+        unknown_data.to_frame().to_csv(unknown_pep_file, sep=',', mode='w', header=True,
+                                       line_terminator='\n')
+
+
+def write_unknown_peptide_data(peptide_data, merged_flag_list, prefix, directory):
+    """Writes filtered dataframe to a new csv file and returns it"""
+    filtered_df = filter_unknown_peptides(peptide_data, merged_flag_list)
+    write_unknown_peptides(filtered_df, prefix, directory)
+    return filtered_df
 
 
 def main(argv):
@@ -67,6 +460,25 @@ def main(argv):
                         help="Provide a prefix for the output file: <PREFIX>_unknown_peptides.csv")
     parser.add_argument('--cpu', action='store', dest="cpu", type=int,
                         help="Provide number of CPUs to be used in this process")
+    parser.add_argument('-i', '--index', action='store', dest="index",
+                        help="Specify the directory of the protein database index created with "
+                             "'protein_index.py build-index', the fasta file won't be parsed when given")
+    parser.add_argument('--digest', action='store', dest="digest",
+                        help="Specify the directory of the digest index created with 'protein_index.py "
+                             "build-digest', only the peptides missing from it are searched in the database")
+    parser.add_argument('--fold', action='append', dest="folding", default=[], choices=list(protein_index.FOLDINGS),
+                        help="Match residues that can't be told apart: 'il' (I/L), 'qk' (Q/K) or 'nd' (deamidation "
+                             "N/D), can be given multiple times. An index or digest needs to be built with the same "
+                             "folding")
+    parser.add_argument('--mapping', action='store_true', dest="mapping",
+                        help="Also write the protein accessions and positions of every peptide to "
+                             "'<PREFIX>_mapping.npz', the digest index isn't used then")
+    parser.add_argument('--max-hits', action='store', dest="max_hits", type=positive_int, default=MAX_HITS,
+                        help="Maximum number of hits recorded per peptide in the mapping")
+    parser.add_argument('--variants', action='store_true', dest="variants",
+                        help="Also search the unknown peptides with one mismatch allowed and write whether each "
+                             "peptide is an exact match, a single amino acid variant or novel to "
+                             "'<PREFIX>_variants.csv'")
 
     args = parser.parse_args()
 
@@ -85,19 +497,25 @@ def main(argv):
         else:
             cpu = os.cpu_count()
 
-        pool = mp.Pool(processes=cpu)
-        results = pool.map(search_peptide_db, [(csv_data, args.database, cpu, i) for i in range(1, cpu + 1)])
-        pool.close()
-        pool.join()
-
-        merged_flags = merge_flags(results)
+        if args.mapping:
+            merged_flags, mapping = map_peptides(csv_data, args.database, cpu, args.index, args.folding,
+                                                 args.max_hits)
+            write_peptide_mapping(mapping, args.prefix, args.outdir)
+        else:
+            merged_flags = search_peptides(csv_data, args.database, cpu, args.index, args.digest, args.folding)
         write_unknown_peptide_data(csv_data, merged_flags, args.prefix, args.outdir)
+        if args.variants:
+            write_variant_peptides(classify_peptides(csv_data, merged_flags, args.database, cpu, args.folding),
+                                   args.prefix, args.outdir)
         print("Finished at: " + datetime.datetime.now().strftime("%d/%m/%Y, %H:%M:%S"))
     except FileNotFoundError as e:
         print(__doc__)
         print("Please provide valid files:")
         print(e)
         sys.exit(2)
+    except protein_index.StaleIndexError as e:
+        print(e)
+        sys.exit(1)
 
 
 if __name__ == '__main__':